@@ -1,25 +1,166 @@
 # NOTE: This implementation is not meant to be memory efficient or fast but rather to test the approximation capabilities of the proposed model class.
 import numpy as np
 from sklearn.linear_model import LassoCV, RidgeCV, Ridge, Lasso
-from scipy.linalg import block_diag, null_space, eigh
+from scipy.linalg import null_space, eigh, cho_factor, cho_solve, LinAlgError
 from bstt import Block, BlockSparseTensor, BlockSparseTT, BlockSparseTTSystem, BlockSparseTTSystem2
 import sys
+import os
 from matplotlib import pyplot as plt
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def local_gram_system(_left, _measure, _right, _blocks, _values, _chunkSize, _executor=None):
+    """
+    Compute `Op.T @ Op` and `Op.T @ _values` for the local operator `Op` of the core with the given `_blocks`.
+
+    The rows of `Op` are `einsum('l,e,r -> ler', _left[n], _measure[n], _right[n])` restricted to the blocks.
+    They are generated in chunks of `_chunkSize` samples, so the (N, dofs) matrix `Op` is never formed.
+    If an `_executor` (e.g. a ThreadPoolExecutor) is given, the chunks are processed concurrently.
+    """
+    N = len(_values)
+    assert _chunkSize > 0
+    def chunk_gram(_start):
+        chunk = slice(_start, min(_start+_chunkSize, N))
+        L, E, R = _left[chunk], _measure[chunk], _right[chunk]
+        Op = np.concatenate([np.einsum('nl,ne,nr -> nler', L[:, block[0]], E[:, block[1]], R[:, block[2]]).reshape(len(L), -1) for block in _blocks], axis=1)
+        return Op.T @ Op, Op.T @ _values[chunk]
+    dofs = sum(Block(block).size for block in _blocks)
+    gram = np.zeros((dofs, dofs))
+    rhs = np.zeros((dofs,) + _values.shape[1:])
+    starts = range(0, N, _chunkSize)
+    for g, r in (map(chunk_gram, starts) if _executor is None else _executor.map(chunk_gram, starts)):
+        gram += g
+        rhs += r
+    return gram, rhs
+
+
+def local_grad_gram_system(_terms, _blocks, _chunkSize):
+    """
+    Compute `sum(einsum('imk,mp,mq,lmn -> iplkqn', L, E, E, R) for L, E, R in _terms)` restricted to the given `_blocks`.
+
+    The left stacks `L` have shape (l,N,l), the measures `E` shape (N,e) and the right stacks `R` shape (r,N,r).
+    For every pair of blocks all terms are reduced by a single matrix product over the samples of all terms.
+    Only the upper block triangle of the (symmetric) result is computed. The samples are processed in chunks of `_chunkSize`.
+    """
+    N = len(_terms[0][1])
+    assert _chunkSize > 0
+    blocks = [Block(block) for block in _blocks]
+    offsets = np.cumsum([0] + [block.size for block in blocks]).tolist()
+    gram = np.zeros((offsets[-1], offsets[-1]))
+    for start in range(0, N, _chunkSize):
+        chunk = slice(start, min(start+_chunkSize, N))
+        terms = [(np.moveaxis(L[:, chunk], 1, 0), E[chunk], np.moveaxis(R[:, chunk], 1, 0)) for L, E, R in _terms]
+        for e1, block1 in enumerate(blocks):
+            for e2 in range(e1, len(blocks)):
+                block2 = blocks[e2]
+                X = np.concatenate([np.einsum('mik,mp,mq -> mipkq', L[:, block1[0], block2[0]], E[:, block1[1]], E[:, block2[1]]).reshape(len(E), -1) for L, E, R in terms])
+                Y = np.concatenate([R[:, block1[2], block2[2]].reshape(len(E), -1) for L, E, R in terms])
+                (i, p, l), (k, q, n) = block1.shape, block2.shape
+                op = (X.T @ Y).reshape(i, p, k, q, l, n).transpose(0, 1, 4, 2, 3, 5)
+                gram[offsets[e1]:offsets[e1+1], offsets[e2]:offsets[e2+1]] += op.reshape(block1.size, block2.size)
+    for e1 in range(len(blocks)):
+        for e2 in range(e1+1, len(blocks)):
+            gram[offsets[e2]:offsets[e2+1], offsets[e1]:offsets[e1+1]] = gram[offsets[e1]:offsets[e1+1], offsets[e2]:offsets[e2+1]].T
+    return gram
+
+
+def write_checkpoint(_file, _bstts, _sweep, _residuals):
+    """
+    Write the components, blocks and core positions of the BlockSparseTTs `_bstts`, the number of finished sweeps `_sweep`
+    and the residual history `_residuals` to the compressed npz archive `_file`.
+
+    Only the data of the non-zero blocks is stored. The archive is written to a temporary file first and then moved to
+    `_file`, so an interruption never leaves a corrupted checkpoint behind.
+    """
+    arrays = {'sweep': _sweep, 'residuals': np.asarray(_residuals, dtype=float), 'numberOfTTs': len(_bstts)}
+    for t, bstt in enumerate(_bstts):
+        arrays[f'corePosition_{t}'] = bstt.corePosition
+        for k in range(bstt.order):
+            comp = bstt.packed_component(k)
+            arrays[f'data_{t}_{k}'] = comp.data
+            arrays[f'shape_{t}_{k}'] = comp.shape
+            arrays[f'blocks_{t}_{k}'] = np.array([[(slc.start, slc.stop) for slc in block] for block in bstt.blocks[k]])
+    with open(_file + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(_file + '.tmp', _file)
+
+
+def read_checkpoint(_file):
+    """
+    Read a checkpoint written by `write_checkpoint`.
+
+    Returns a list that contains a triple `(components, blocks, corePosition)` for every BlockSparseTT, where the components
+    are BlockSparseTensors, as well as the number of finished sweeps and the residual history.
+    """
+    with np.load(_file) as checkpoint:
+        order = sum(name.startswith('data_0_') for name in checkpoint.files)
+        bstts = []
+        for t in range(int(checkpoint['numberOfTTs'])):
+            blocks = [[Block(tuple(slice(int(start), int(stop)) for start, stop in block)) for block in checkpoint[f'blocks_{t}_{k}']] for k in range(order)]
+            components = [BlockSparseTensor(checkpoint[f'data_{t}_{k}'], blocks[k], tuple(checkpoint[f'shape_{t}_{k}'])) for k in range(order)]
+            bstts.append((components, blocks, int(checkpoint[f'corePosition_{t}'])))
+        return bstts, int(checkpoint['sweep']), checkpoint['residuals'].tolist()
+
+
+def load_checkpoint_data(_bstt, _components, _blocks, _corePosition):
+    """
+    Replace the components, blocks and core position of `_bstt` by the ones read from a checkpoint (see `read_checkpoint`).
+    """
+    _bstt.blocks = _blocks
+    _bstt.components = _components if _bstt.packed else [comp.toarray() for comp in _components]
+    _bstt.assume_corePosition(_corePosition)
+    _bstt.verify()
+
+
+def contract_stack(_bstt, _position, _stack, _measure, _direction):
+    """
+    Extend `_stack` by the `_position`-th component of `_bstt` (from the right for `_direction == 'left'` and from the left otherwise).
+    """
+    if _direction == 'left':
+        return _bstt.contract_right(_position, _stack, _measure)
+    return _bstt.contract_left(_position, _stack, _measure)
+
+
+def solve_least_squares(_op, _rhs):
+    """
+    Return the (minimal norm) least squares solution of `_op @ x = _rhs`.
+    """
+    res, *_ = np.linalg.lstsq(_op, _rhs, rcond=None)
+    return res
+
+
+def solve_gram_system(_gram, _rhs):
+    """
+    Solve `_gram @ x = _rhs` for a symmetric positive semi-definite `_gram`.
+
+    Uses a Cholesky factorisation. If `_gram` is singular (e.g. when there are less samples than dofs) the minimal norm least squares solution is returned.
+    """
+    try:
+        return cho_solve(cho_factor(_gram), _rhs)
+    except LinAlgError:
+        res, *_ = np.linalg.lstsq(_gram, _rhs, rcond=None)
+        return res
 
 
 class ALS(object):
     """
-    This is the standard scalar ALS on block sparse tensor trains. As methods there are l1 and l2. l2 is the standard least square solver.
+    This is the standard scalar ALS on block sparse tensor trains. As methods there are l1, l2 and l2gram. l2 is the standard least square solver.
+    l2gram solves the same least squares problem via the normal equations, which are accumulated in chunks of chunkSize samples.
     l1 is the regularized Lasso solver (see Philipp Trunsckes papers).
+    l1warm solves the same Lasso problem but only cross validates the regularization parameter every lassoCVInterval sweeps.
+    In between the previous parameter of the component is reused and the coordinate descent is started from the current core.
     By selecting increase rank and setting _maxGroupSize one gets rank adaptvity in the sense of shadow ranks as introduced by Sebastian Kraemer.
+    After initialSweeps sweeps, every move of the core grows each block whose singular values all exceed smin by one, until the block reaches
+    MaxSize (bounded by _maxGroupSize, an int or a list with one entry per component). This allows to start with small blocks.
+    Conversely, with truncationTolerance > 0 every move of the core drops the singular values (and the corresponding block rows and columns)
+    that are smaller than truncationTolerance times the largest singular value of the edge.
     """
     def __init__(self, _bstt, _measurements, _values, _localL2Gramians=None, _localH1Gramians=None, _maxGroupSize=3, _verbosity=0):
         assert isinstance(_bstt, BlockSparseTT)
         self.bstt = _bstt
-        assert isinstance(_measurements, np.ndarray) and isinstance(
-            _values, np.ndarray)
-        assert _maxGroupSize > 0
+        assert isinstance(_values, np.ndarray)  # _measurements may be an ndarray or any sequence of per-position measures (e.g. misc.Measures)
+        assert np.all(np.asarray(_maxGroupSize) > 0)
         assert len(_measurements) == self.bstt.order
         assert all(compMeas.shape == (len(_values), dim)
                    for compMeas, dim in zip(_measurements, self.bstt.dimensions))
@@ -34,7 +175,18 @@ class ALS(object):
         self.smin = 0.01
         self.sminFactor = 0.01
         self.maxGroupSize = _maxGroupSize
+        self.increasedBlocks = 0  # number of blocks grown since the start of the current sweep
+        self.truncationTolerance = 0  # relative tolerance for discarding singular values when the core is moved (0: no truncation)
         self.method = 'l1'
+        self.chunkSize = 10000  # number of samples per chunk for method 'l2gram'
+        self.lassoCVInterval = 5  # number of sweeps between two cross validations of the regularization parameters for method 'l1warm'
+        self.lassoAlphas = [None]*self.bstt.order  # last regularization parameter chosen by the cross validation for each component
+        self.sweep = 0
+        self.startSweep = 0  # index of the first sweep of run (set by resume)
+        self.residuals = []  # residual history: the initial residual and the residual after every sweep
+        self.checkpointFile = None  # if set, run writes a checkpoint (see write_checkpoint) to this file
+        self.checkpointInterval = 1  # number of sweeps between two checkpoints
+        self.stackDtype = np.float64  # dtype of the left and right stacks (the local problems are always solved in float64)
 
         if (not _localH1Gramians):
             self.localH1Gramians = [np.eye(d) for d in self.bstt.dimensions]
@@ -64,9 +216,9 @@ class ALS(object):
                     lG, lG.T, rtol=1e-14, atol=1e-14)
             self.localL2Gramians = _localL2Gramians
 
-        self.leftStack = [np.ones((len(self.values), 1))] + \
+        self.leftStack = [np.ones((len(self.values), 1), dtype=self.stackDtype)] + \
             [None]*(self.bstt.order-1)
-        self.rightStack = [np.ones((len(self.values), 1))]
+        self.rightStack = [np.ones((len(self.values), 1), dtype=self.stackDtype)]
         self.leftH1GramianStack = [
             np.ones([1, 1])] + [None]*(self.bstt.order-1)
         self.rightH1GramianStack = [np.ones([1, 1])]
@@ -88,17 +240,25 @@ class ALS(object):
             entry is not None for entry in self.leftStack + self.rightStack)
         if self.verbosity >= 2 and valid_stacks:
             pre_res = self.residual()
-        singValues = self.bstt.move_core(_direction)
+        singValues = self.bstt.move_core(_direction, self.truncationTolerance)
         if _direction == 'left':
+            if self.increaseRanks:
+                self.increase_ranks(singValues, _direction)
+
             self.leftStack.pop()
             self.leftH1GramianStack.pop()
             self.leftL2GramianStack.pop()
-            self.rightStack.append(np.einsum(
-                'ler, ne, nr -> nl', self.bstt.components[self.bstt.corePosition+1], self.measurements[self.bstt.corePosition+1], self.rightStack[-1]))
-            self.rightH1GramianStack.append(np.einsum(
-                'ijk, lmn, jm,kn -> il', self.bstt.components[self.bstt.corePosition+1],  self.bstt.components[self.bstt.corePosition+1], self.localH1Gramians[self.bstt.corePosition+1], self.rightH1GramianStack[-1]))
-            self.rightL2GramianStack.append(np.einsum(
-                'ijk, lmn, jm,kn -> il', self.bstt.components[self.bstt.corePosition+1],  self.bstt.components[self.bstt.corePosition+1], self.localL2Gramians[self.bstt.corePosition+1], self.rightL2GramianStack[-1]))
+            self.rightStack.append(self.bstt.contract_right(
+                self.bstt.corePosition+1, self.rightStack[-1], self.measurements[self.bstt.corePosition+1]))
+            if self.gramians_needed() and self.rightH1GramianStack[-1] is not None:
+                comp = self.bstt.dense_component(self.bstt.corePosition+1)
+                self.rightH1GramianStack.append(np.einsum(
+                    'ijk, lmn, jm,kn -> il', comp,  comp, self.localH1Gramians[self.bstt.corePosition+1], self.rightH1GramianStack[-1]))
+                self.rightL2GramianStack.append(np.einsum(
+                    'ijk, lmn, jm,kn -> il', comp,  comp, self.localL2Gramians[self.bstt.corePosition+1], self.rightL2GramianStack[-1]))
+            else:
+                self.rightH1GramianStack.append(None)
+                self.rightL2GramianStack.append(None)
             if self.verbosity >= 2:
                 if valid_stacks:
                     print(
@@ -108,29 +268,22 @@ class ALS(object):
                         f"move_core {self.bstt.corePosition+1} --> {self.bstt.corePosition}.")
         elif _direction == 'right':
             if self.increaseRanks:
-                slices = self.bstt.getUniqueSlices(0)
-                for i, slc in zip(reversed(range(len(slices))), reversed(slices)):
-                    if np.min(singValues[slc]) > self.smin and slc.stop-slc.start < self.bstt.MaxSize(i, self.bstt.corePosition-1, self.maxGroupSize):
-                        assert np.allclose(np.einsum('ijk,ijl->kl', self.bstt.components[self.bstt.corePosition-1], self.bstt.components[self.bstt.corePosition-1]), np.eye(
-                            self.bstt.components[self.bstt.corePosition-1].shape[2]), rtol=1e-12, atol=1e-12)
-                        u = self.calculate_update(slc, 'left')
-                        self.bstt.increase_block(i, u, np.zeros(
-                            self.bstt.components[self.bstt.corePosition].shape[1:3]), 'left')
-                        assert np.allclose(np.einsum('ijk,ijl->kl', self.bstt.components[self.bstt.corePosition-1], self.bstt.components[self.bstt.corePosition-1]), np.eye(
-                            self.bstt.components[self.bstt.corePosition-1].shape[2]), rtol=1e-12, atol=1e-12)
-                        if self.verbosity >= 2:
-                            print(
-                                f"Increased block {i} mode 2 of componment {self.bstt.corePosition-1}. Size before {slc.stop-slc.start}, size now {slc.stop-slc.start+1} of maximal Size {self.bstt.MaxSize(i,self.bstt.corePosition-1,self.maxGroupSize)}")
+                self.increase_ranks(singValues, _direction)
 
             self.rightStack.pop()
             self.rightH1GramianStack.pop()
             self.rightL2GramianStack.pop()
-            self.leftStack.append(np.einsum(
-                'nl, ne, ler -> nr', self.leftStack[-1], self.measurements[self.bstt.corePosition-1], self.bstt.components[self.bstt.corePosition-1]))
-            self.leftH1GramianStack.append(np.einsum(
-                'ijk, lmn, jm,il -> kn', self.bstt.components[self.bstt.corePosition-1],  self.bstt.components[self.bstt.corePosition-1], self.localH1Gramians[self.bstt.corePosition-1], self.leftH1GramianStack[-1]))
-            self.leftL2GramianStack.append(np.einsum(
-                'ijk, lmn, jm,il -> kn', self.bstt.components[self.bstt.corePosition-1],  self.bstt.components[self.bstt.corePosition-1], self.localL2Gramians[self.bstt.corePosition-1], self.leftL2GramianStack[-1]))
+            self.leftStack.append(self.bstt.contract_left(
+                self.bstt.corePosition-1, self.leftStack[-1], self.measurements[self.bstt.corePosition-1]))
+            if self.gramians_needed() and self.leftH1GramianStack[-1] is not None:
+                comp = self.bstt.dense_component(self.bstt.corePosition-1)
+                self.leftH1GramianStack.append(np.einsum(
+                    'ijk, lmn, jm,il -> kn', comp,  comp, self.localH1Gramians[self.bstt.corePosition-1], self.leftH1GramianStack[-1]))
+                self.leftL2GramianStack.append(np.einsum(
+                    'ijk, lmn, jm,il -> kn', comp,  comp, self.localL2Gramians[self.bstt.corePosition-1], self.leftL2GramianStack[-1]))
+            else:
+                self.leftH1GramianStack.append(None)
+                self.leftL2GramianStack.append(None)
             if self.verbosity >= 2:
                 if valid_stacks:
                     print(
@@ -142,12 +295,104 @@ class ALS(object):
             raise ValueError(
                 f"Unknown _direction. Expected 'left' or 'right' but got '{_direction}'")
 
+    def increase_ranks(self, _singValues, _direction):
+        """
+        Grow the blocks of the edge that the core has just been moved across (in `_direction`).
+
+        `_singValues` are the singular values returned by `self.bstt.move_core(_direction)`.
+        Every block whose singular values all exceed `self.smin` and that is smaller than its `MaxSize` is increased by one.
+        The new basis function of the orthogonal component is chosen by `calculate_update` and the core is extended by zeros.
+        Hence the represented function does not change.
+        """
+        if _direction == 'right':
+            edge, mode = self.bstt.corePosition-1, 0
+        else:
+            edge, mode = self.bstt.corePosition, 2
+        maxGroupSize = self.maxGroupSize if np.ndim(self.maxGroupSize) == 0 else self.maxGroupSize[edge]
+        slices = self.bstt.getUniqueSlices(mode)
+        # Growing a block shifts all subsequent slices. Hence we have to start with the last one.
+        for i, slc in zip(reversed(range(len(slices))), reversed(slices)):
+            maxSize = self.bstt.MaxSize(i, edge, maxGroupSize)
+            if np.min(_singValues[slc]) <= self.smin or slc.stop-slc.start >= maxSize:
+                continue
+            if _direction == 'right':
+                u = self.calculate_update(slc, 'left')
+                self.bstt.increase_block(i, u, np.zeros(
+                    self.bstt.components[self.bstt.corePosition].shape[1:3]), 'left')
+                prevComp = self.bstt.dense_component(edge)
+                assert np.allclose(np.einsum('ijk,ijl->kl', prevComp, prevComp), np.eye(
+                    prevComp.shape[2]), rtol=1e-12, atol=1e-12)
+            else:
+                v = self.calculate_update(slc, 'right')
+                self.bstt.increase_block(i, np.zeros(
+                    self.bstt.components[self.bstt.corePosition].shape[0:2]), v, 'right')
+                nextComp = self.bstt.dense_component(edge+1)
+                assert np.allclose(np.einsum('ijk,ljk->il', nextComp, nextComp), np.eye(
+                    nextComp.shape[0]), rtol=1e-12, atol=1e-12)
+            self.increasedBlocks += 1
+            if self.verbosity >= 2:
+                print(
+                    f"Increased block {i} between the componments {edge} and {edge+1}. Size before {slc.stop-slc.start}, size now {slc.stop-slc.start+1} of maximal Size {maxSize}")
+
+    def rebuild_stacks(self):
+        """
+        Recompute the left and right stacks (in `self.stackDtype`) and the Gramian stacks for the current core position.
+        """
+        pos = self.bstt.corePosition
+        self.leftStack = [np.ones((len(self.values), 1), dtype=self.stackDtype)]
+        self.leftH1GramianStack = [np.ones([1, 1])]
+        self.leftL2GramianStack = [np.ones([1, 1])]
+        for k in range(pos):
+            self.leftStack.append(self.bstt.contract_left(k, self.leftStack[-1], self.measurements[k]))
+            if self.gramians_needed():
+                comp = self.bstt.dense_component(k)
+                self.leftH1GramianStack.append(np.einsum(
+                    'ijk, lmn, jm,il -> kn', comp,  comp, self.localH1Gramians[k], self.leftH1GramianStack[-1]))
+                self.leftL2GramianStack.append(np.einsum(
+                    'ijk, lmn, jm,il -> kn', comp,  comp, self.localL2Gramians[k], self.leftL2GramianStack[-1]))
+            else:
+                self.leftH1GramianStack.append(None)
+                self.leftL2GramianStack.append(None)
+        self.rightStack = [np.ones((len(self.values), 1), dtype=self.stackDtype)]
+        self.rightH1GramianStack = [np.ones([1, 1])]
+        self.rightL2GramianStack = [np.ones([1, 1])]
+        for k in reversed(range(pos+1, self.bstt.order)):
+            self.rightStack.append(self.bstt.contract_right(k, self.rightStack[-1], self.measurements[k]))
+            if self.gramians_needed():
+                comp = self.bstt.dense_component(k)
+                self.rightH1GramianStack.append(np.einsum(
+                    'ijk, lmn, jm,kn -> il', comp,  comp, self.localH1Gramians[k], self.rightH1GramianStack[-1]))
+                self.rightL2GramianStack.append(np.einsum(
+                    'ijk, lmn, jm,kn -> il', comp,  comp, self.localL2Gramians[k], self.rightL2GramianStack[-1]))
+            else:
+                self.rightH1GramianStack.append(None)
+                self.rightL2GramianStack.append(None)
+
+    def gramians_needed(self):
+        """
+        The Gramian stacks are only used by the Lasso methods and by the rank increase. Otherwise `move_core` and
+        `rebuild_stacks` push `None` instead (and the components are not densified).
+        """
+        return self.method in ['l1', 'l1warm'] or self.increaseRanks
+
+    def resume(self, _checkpointFile):
+        """
+        Restore the tensor train, the number of finished sweeps and the residual history from a checkpoint written by `run`.
+
+        The stacks are rebuilt, so a subsequent call of `run` continues with the next sweep.
+        """
+        bstts, sweep, residuals = read_checkpoint(_checkpointFile)
+        assert len(bstts) == 1
+        load_checkpoint_data(self.bstt, *bstts[0])
+        self.startSweep = sweep
+        self.residuals = residuals
+        self.rebuild_stacks()
+
     def residual(self):
-        core = self.bstt.components[self.bstt.corePosition]
-        L = self.leftStack[-1]
+        L = self.leftStack[-1].astype(np.float64, copy=False)
         E = self.measurements[self.bstt.corePosition]
-        R = self.rightStack[-1]
-        pred = np.einsum('ler,nl,ne,nr -> n', core, L, E, R)
+        R = self.rightStack[-1].astype(np.float64, copy=False)
+        pred = np.einsum('nr,nr -> n', self.bstt.contract_left(self.bstt.corePosition, L, E), R)
         return np.linalg.norm(pred - self.values) / np.linalg.norm(self.values)
 
     def calculate_update(self, slc, _direction):
@@ -162,28 +407,51 @@ class ALS(object):
             for block in blocks:
                 basis[block[0], block[1], block[0], block[1]] = 0
             basis = basis.reshape(n, n)
-            left = self.bstt.components[self.bstt.corePosition -
-                                        1][:, :, slc].reshape(n, -1)
+            left = self.bstt.dense_component(self.bstt.corePosition -
+                                             1)[:, :, slc].reshape(n, -1)
             basis = np.concatenate([basis, left], axis=1)
             ns = null_space(basis.T)
             assert ns.size > 0
             ns = np.round(ns.reshape(*Gramian.shape[0:2], -1), decimals=14)
             projGramian = np.einsum('ijkl,ijm,kln->mn', Gramian, ns, ns)
             pGe, pGP = np.linalg.eigh(projGramian)
-            return np.einsum('ijk,k->ij', ns, pGP[0])
+            return np.einsum('ijk,k->ij', ns, pGP[:, 0])
+        elif _direction == 'right':
+            Gramian = np.einsum(
+                'ij,kl->ikjl', self.localH1Gramians[self.bstt.corePosition+1], self.rightH1GramianStack[-1])
+            n = Gramian.shape[0]*Gramian.shape[1]
+            basis = np.eye(n)
+            basis = basis.reshape(Gramian.shape)
+            blocks = self.bstt.getAllBlocksOfSlice(
+                self.bstt.corePosition+1, slc, 0)
+            for block in blocks:
+                basis[block[1], block[2], block[1], block[2]] = 0
+            basis = basis.reshape(n, n)
+            right = self.bstt.dense_component(self.bstt.corePosition +
+                                              1)[slc].reshape(-1, n).T
+            basis = np.concatenate([basis, right], axis=1)
+            ns = null_space(basis.T)
+            assert ns.size > 0
+            ns = np.round(ns.reshape(*Gramian.shape[0:2], -1), decimals=14)
+            projGramian = np.einsum('ijkl,ijm,kln->mn', Gramian, ns, ns)
+            pGe, pGP = np.linalg.eigh(projGramian)
+            return np.einsum('ijk,k->ij', ns, pGP[:, 0])
+        else:
+            raise ValueError(
+                f"Unknown _direction. Expected 'left' or 'right' but got '{_direction}'")
 
     def microstep(self):
         if self.verbosity >= 2:
             pre_res = self.residual()
 
-        core = self.bstt.components[self.bstt.corePosition]
-        L = self.leftStack[-1]
-        E = self.measurements[self.bstt.corePosition]
-        R = self.rightStack[-1]
+        # The local problem is always assembled and solved in float64.
+        L = self.leftStack[-1].astype(np.float64, copy=False)
+        E = np.asarray(self.measurements[self.bstt.corePosition], dtype=np.float64)
+        R = self.rightStack[-1].astype(np.float64, copy=False)
         coreBlocks = self.bstt.blocks[self.bstt.corePosition]
         N = len(self.values)
         
-        if self.method == 'l1':
+        if self.method in ['l1', 'l1warm']:
             LGH1 = self.leftH1GramianStack[-1]
             EGH1 = self.localH1Gramians[self.bstt.corePosition]
             RGH1 = self.rightH1GramianStack[-1]
@@ -193,14 +461,12 @@ class ALS(object):
             RGL2 = self.rightL2GramianStack[-1]
             assert np.allclose(LGL2, np.eye(LGL2.shape[0]), rtol=1e-12, atol=1e-12)
     
-            Op_blocks = []
+            # The transform is the block diagonal matrix of the Kronecker products LP⊗EP⊗RP and the weights are diagonal.
+            # Both are applied block by block, i.e. the operator is assembled in the rotated basis directly.
+            OpTr_blocks = []
             Weights = []
             Tr_blocks = []
             for block in coreBlocks:
-                op = np.einsum('nl,ne,nr -> nler',
-                               L[:, block[0]], E[:, block[1]], R[:, block[2]])
-                Op_blocks.append(op.reshape(N, -1))
-    
                 # update stacks after diagonalization of left and right gramian
                 Le, LP = np.linalg.eigh(LGH1[block[0], block[0]])
                 Ee, EP = np.linalg.eigh(EGH1[block[1], block[1]])
@@ -211,26 +477,47 @@ class ALS(object):
                 RPL2 = RP.T@RGL2[block[2], block[2]]@RP
                 Re = Re/np.diag(RPL2)
     
-                tr = np.einsum('il,jm,kn->ijklmn', LP, EP, RP)
-                Tr_blocks.append(tr.reshape(
-                    Op_blocks[-1].shape[1], Op_blocks[-1].shape[1]))
-    
-                Weights.extend(np.einsum('i,j,k->ijk', Le, Ee, Re).reshape(-1))
-            Op = np.concatenate(Op_blocks, axis=1)
-            Transform = block_diag(*Tr_blocks)
-            assert np.allclose(Transform@Transform.T,
-                               np.eye(Transform.shape[0]), rtol=1e-14, atol=1e-14)
-    
-            Weights = np.sqrt(Weights)
-            inverseWeightMatrix = np.diag(np.reciprocal(Weights))
-    
-            OpTr = Op@Transform@inverseWeightMatrix
-            reg = LassoCV(eps=1e-7, cv=10, random_state=0,
-                          fit_intercept=False).fit(OpTr, self.values)
+                weights = np.sqrt(np.einsum('i,j,k->ijk', Le, Ee, Re))
+                op = np.einsum('nl,ne,nr -> nler',
+                               L[:, block[0]]@LP, E[:, block[1]]@EP, R[:, block[2]]@RP) / weights
+                OpTr_blocks.append(op.reshape(N, -1))
+                Tr_blocks.append((LP, EP, RP))
+                Weights.append(weights)
+            OpTr = np.concatenate(OpTr_blocks, axis=1)
+
+            def transform(_coefficients):
+                # Map the coefficients of OpTr to the data of the core blocks.
+                data, offset = [], 0
+                for (LP, EP, RP), weights in zip(Tr_blocks, Weights):
+                    coeffs = _coefficients[offset:offset+weights.size].reshape(weights.shape) / weights
+                    data.append(np.einsum('il,jm,kn,lmn -> ijk', LP, EP, RP, coeffs).reshape(-1))
+                    offset += weights.size
+                return np.concatenate(data)
+
+            def inverse_transform(_data):
+                # Map the data of the core blocks to the coefficients of OpTr (the transforms are orthogonal).
+                coefficients, offset = [], 0
+                for (LP, EP, RP), weights in zip(Tr_blocks, Weights):
+                    data = _data[offset:offset+weights.size].reshape(weights.shape)
+                    coefficients.append((weights * np.einsum('il,jm,kn,ijk -> lmn', LP, EP, RP, data)).reshape(-1))
+                    offset += weights.size
+                return np.concatenate(coefficients)
+
+            pos = self.bstt.corePosition
+            if self.method == 'l1' or self.lassoAlphas[pos] is None or self.sweep % self.lassoCVInterval == 0:
+                reg = LassoCV(eps=1e-7, cv=10, random_state=0,
+                              fit_intercept=False).fit(OpTr, self.values)
+                self.lassoAlphas[pos] = reg.alpha_
+            else:
+                # Start from the current core.
+                # For N > dofs the coordinate descent on the precomputed Gram matrix is cheaper than on OpTr.
+                gram = OpTr.T @ OpTr if N > OpTr.shape[1] else False
+                reg = Lasso(alpha=self.lassoAlphas[pos], fit_intercept=False, precompute=gram, warm_start=True)
+                reg.coef_ = inverse_transform(self.bstt.packed_component(pos).data)
+                reg.fit(OpTr, self.values)
             Res = reg.coef_
     
-            core[...] = BlockSparseTensor(
-                Transform@inverseWeightMatrix@Res, coreBlocks, core.shape).toarray()
+            self.bstt.set_component(self.bstt.corePosition, transform(Res))
         elif self.method == 'l2':
             Op_blocks = []
             for block in coreBlocks:
@@ -239,35 +526,55 @@ class ALS(object):
             Op = np.concatenate(Op_blocks, axis=1)
             # Res = np.linalg.solve(Op.T @ Op, Op.T @ self.values)
             Res, *_ = np.linalg.lstsq(Op, self.values, rcond=None)  # When Op.T@Op is singular (less samples then dofs in this component) then lstsq returns the minimal norm solution.
-            core[...] = BlockSparseTensor(Res, coreBlocks, core.shape).toarray()
+            self.bstt.set_component(self.bstt.corePosition, Res)
+        elif self.method == 'l2gram':
+            # Solve the normal equations. Memory is O(dofs**2 + chunkSize*dofs) instead of O(N*dofs).
+            gram, rhs = local_gram_system(L, E, R, coreBlocks, self.values, self.chunkSize)
+            Res = solve_gram_system(gram, rhs)
+            self.bstt.set_component(self.bstt.corePosition, Res)
         else:
-            assert False, "No valid method chosen, methods are l1 or l2"
+            assert False, "No valid method chosen, methods are l1, l1warm, l2 or l2gram"
         if self.verbosity >= 2:
             print(
                 f"microstep.  (residual: {pre_res:.2e} --> {self.residual():.2e})")
 
     def run(self):
+        if self.leftStack[0].dtype != self.stackDtype:
+            self.rebuild_stacks()
         prev_residual = self.residual()
         self.smin = prev_residual*self.sminFactor
+        if not self.residuals:
+            self.residuals.append(prev_residual)
         if self.verbosity >= 1:
             print(f"Initial residuum: {prev_residual:.2e}")
         increaseRanks = False  # prepare initial sweeps before rank increase
         if self.increaseRanks:
             increaseRanks = True
             self.increaseRanks = False
-        for sweep in range(self.maxSweeps):
+        for sweep in range(self.startSweep, self.maxSweeps):
             if sweep >= self.initialSweeps and increaseRanks == True:
                 self.increaseRanks = True
+            self.increasedBlocks = 0
+            self.sweep = sweep
+            if self.gramians_needed() and (self.leftH1GramianStack[-1] is None or self.rightH1GramianStack[-1] is None):
+                self.rebuild_stacks()  # the Gramian stacks were skipped so far (e.g. method or increaseRanks changed)
             while self.bstt.corePosition < self.bstt.order-1:
                 self.microstep()
                 self.move_core('right')
             while self.bstt.corePosition > 0:
                 self.microstep()
                 self.move_core('left')
+            if self.bstt.verifyLevel != 'off':
+                self.bstt.verify()
 
             residual = self.residual()
+            self.residuals.append(residual)
             if self.verbosity >= 1:
                 print(f"[{sweep}] Residuum: {residual:.2e}")
+                if self.increasedBlocks > 0:
+                    print(f"[{sweep}] Increased {self.increasedBlocks} blocks (dofs: {self.bstt.dofs()})")
+            if self.checkpointFile is not None and (sweep+1) % self.checkpointInterval == 0:
+                write_checkpoint(self.checkpointFile, [self.bstt], sweep+1, self.residuals)
 
             if residual < self.targetResidual:
                 if self.verbosity >= 1:
@@ -275,13 +582,23 @@ class ALS(object):
                     print(f"Final residuum: {self.residual():.2e}")
                 return
 
+            if (residual > prev_residual or (prev_residual - residual) < self.minDecrease*residual) and np.dtype(self.stackDtype) != np.float64:
+                # The stagnation may be caused by the reduced precision of the stacks.
+                if self.verbosity >= 1:
+                    print(f"Switching to float64 stacks (convergence stalls with {np.dtype(self.stackDtype).name})")
+                self.stackDtype = np.float64
+                self.rebuild_stacks()
+                prev_residual = residual
+                continue
+
             if residual > prev_residual:
                 if self.verbosity >= 1:
                     print(f"Terminating (residual increases)")
                     print(f"Final residuum: {self.residual():.2e}")
                 return
 
-            if (prev_residual - residual) < self.minDecrease*residual:
+            # The new blocks are initialized with zeros. Their contribution is only visible after the next sweep.
+            if (prev_residual - residual) < self.minDecrease*residual and self.increasedBlocks == 0:
                 if self.verbosity >= 1:
                     print(f"Terminating (minDecrease reached)")
                     print(f"Final residuum: {self.residual():.2e}")
@@ -304,7 +621,9 @@ class ALSGrad(object):
     '''
     def __init__(self, _bstt, _measurements,_measurements_grad, _values, _verbosity=0):
         self.bstt = _bstt
-        assert isinstance(_measurements, np.ndarray) and isinstance(_values, np.ndarray)
+        assert isinstance(_values, np.ndarray)  # _measurements may be an ndarray or any sequence of per-position measures (e.g. misc.GradientMeasures.measures)
+        if hasattr(_measurements_grad, 'derivatives'):  # misc.GradientMeasures
+            _measurements_grad = _measurements_grad.derivatives
         assert len(_measurements) == self.bstt.order
         assert len(_measurements_grad) == self.bstt.order or  len(_measurements_grad) == self.bstt.order -1
         assert all(compMeas.shape == (len(_values), dim) for compMeas, dim in zip(_measurements, self.bstt.dimensions))
@@ -315,6 +634,7 @@ class ALSGrad(object):
         self.maxSweeps = 100
         self.targetResidual = 1e-8
         self.minDecrease = 1e-4
+        self.chunkSize = 10000  # number of samples per chunk for the assembly of the local system
 
         self.leftStack1 = [np.ones((1,len(self.values),1))] + [None]*(self.bstt.order-1)
         self.leftStack2 = [np.ones((1,len(self.values),1))] + [None]*(self.bstt.order-1)
@@ -342,14 +662,14 @@ class ALSGrad(object):
             self.leftStack2.pop()
             self.leftStack1rhs.pop()
             self.leftStack2rhs.pop()
-            comp_measure = np.einsum('ler, me  -> lmr', self.bstt.components[self.bstt.corePosition+1], self.measurements[self.bstt.corePosition+1])
+            comp_measure = np.einsum('ler, me  -> lmr', self.bstt.dense_component(self.bstt.corePosition+1), self.measurements[self.bstt.corePosition+1])
             if self.bstt.corePosition+1 == self.bstt.order-1:
                 self.rightStack1.append(np.einsum('imk, lmn, kmn -> iml', comp_measure,comp_measure, self.rightStack1[-1]))
                 self.rightStack2.append(np.einsum('imk, lmn, kmn -> iml', comp_measure,comp_measure, self.rightStack2[-1]))
                 self.rightStack1rhs.append(np.einsum('imk, km -> im', comp_measure, self.rightStack1rhs[-1]))
                 self.rightStack2rhs.append(np.einsum('imk, km -> im', comp_measure, self.rightStack2rhs[-1]))
             else:
-                comp_measure_grad = np.einsum('ler, me  -> lmr', self.bstt.components[self.bstt.corePosition+1], self.measurements_grad[self.bstt.corePosition+1])
+                comp_measure_grad = np.einsum('ler, me  -> lmr', self.bstt.dense_component(self.bstt.corePosition+1), self.measurements_grad[self.bstt.corePosition+1])
                 stack2 = np.einsum('imk, lmn, kmn -> iml', comp_measure_grad,comp_measure_grad, self.rightStack1[-1])
                 stack2rhs = np.einsum('imk, m,km -> im', comp_measure_grad,self.values[:,self.bstt.corePosition+1],  self.rightStack1rhs[-1])
                 if self.bstt.corePosition+1 < self.bstt.order-2:
@@ -372,8 +692,9 @@ class ALSGrad(object):
             self.rightStack1rhs.pop()
             self.rightStack2rhs.pop()
 
-            comp_measure = np.einsum('ler, me  -> lmr', self.bstt.components[self.bstt.corePosition-1], self.measurements[self.bstt.corePosition-1])
-            comp_measure_grad = np.einsum('ler, me  -> lmr', self.bstt.components[self.bstt.corePosition-1], self.measurements_grad[self.bstt.corePosition-1])
+            comp = self.bstt.dense_component(self.bstt.corePosition-1)
+            comp_measure = np.einsum('ler, me  -> lmr', comp, self.measurements[self.bstt.corePosition-1])
+            comp_measure_grad = np.einsum('ler, me  -> lmr', comp, self.measurements_grad[self.bstt.corePosition-1])
             stack2 = np.einsum('iml,imk, lmn -> kmn',  self.leftStack1[-1], comp_measure_grad, comp_measure_grad)
             stack2rhs = np.einsum('im, m,imk -> km', self.leftStack1rhs[-1],self.values[:,self.bstt.corePosition-1], comp_measure_grad )
             if self.bstt.corePosition-1 > 0:
@@ -394,19 +715,13 @@ class ALSGrad(object):
             raise ValueError(f"Unknown _direction. Expected 'left' or 'right' but got '{_direction}'")
 
     def residual(self):
-        res = 0
-        for pos in range(self.bstt.order-1):
-            tmp_measures = self.measurements.copy()
-            tmp_measures[pos] = self.measurements_grad[pos]
-            tmp_res = self.bstt.evaluate(tmp_measures)
-            res += np.linalg.norm(tmp_res -  self.values[:,pos])**2    
-        return np.sqrt(res) / np.linalg.norm(self.values)
+        grad = self.bstt.gradient(self.measurements, self.measurements_grad[:self.bstt.order-1])
+        return np.linalg.norm(grad - self.values[:, :self.bstt.order-1]) / np.linalg.norm(self.values)
 
     def microstep(self):
         if self.verbosity >= 2:
             pre_res = self.residual()
 
-        core = self.bstt.components[self.bstt.corePosition]
         L1 = self.leftStack1[-1]
         L2 = self.leftStack2[-1]
         L1rhs = self.leftStack1rhs[-1]
@@ -415,41 +730,29 @@ class ALSGrad(object):
         E_grad = self.measurements_grad[self.bstt.corePosition]
  
 
-        E_op = np.einsum('mp,mq->pmq',E,E)
-        E_grad_op = np.einsum('mp,mq->pmq',E_grad,E_grad)
         R1 = self.rightStack1[-1]
         R2 = self.rightStack2[-1]
         R1rhs = self.rightStack1rhs[-1]
         R2rhs = self.rightStack2rhs[-1]
         coreBlocks = self.bstt.blocks[self.bstt.corePosition]
 
-        Op_blocks = []
+        terms = [(L2, E, R1), (L1, E_grad, R1)]
+        if self.bstt.corePosition < self.bstt.order-2:
+            terms.append((L1, E, R2))
+        Op = local_grad_gram_system(terms, coreBlocks, self.chunkSize)
+
         Rhs_blocks = []
         for block1 in coreBlocks:
-            Op_blocks_col = []
-            for block2 in coreBlocks:
-                op = np.einsum('imk,pmq,lmn -> iplkqn', L2[block1[0],:, block2[0]], E_op[block1[1],:, block2[1]], R1[block1[2],:, block2[2]])
-                if self.bstt.corePosition < self.bstt.order-2:
-                    op += np.einsum('imk,pmq,lmn -> iplkqn', L1[block1[0],:, block2[0]], E_op[block1[1],:, block2[1]], R2[block1[2],:, block2[2]])
-                op += np.einsum('imk,pmq,lmn -> iplkqn', L1[block1[0],:, block2[0]], E_grad_op[block1[1],:, block2[1]], R1[block1[2],:, block2[2]])
-                dim1 = op.shape[0]*op.shape[1]*op.shape[2]
-                dim2 = op.shape[3]*op.shape[4]*op.shape[5]
-                Op_blocks_col.append( op.reshape(dim1,dim2))
-            
             rhs = np.einsum('im,mp,lm -> ipl', L2rhs[block1[0],:], E[:,block1[1]], R1rhs[block1[2],:])
             if self.bstt.corePosition < self.bstt.order-2:
                 rhs += np.einsum('im,mp,lm -> ipl', L1rhs[block1[0],:], E[:,block1[1]], R2rhs[block1[2],:])
             rhs += np.einsum('im,mp,lm,m -> ipl', L1rhs[block1[0],:], E_grad[:,block1[1]], R1rhs[block1[2],:],self.values[:,self.bstt.corePosition])
-            rhs = rhs.reshape(dim1)
-            
-            Rhs_blocks.append(rhs.reshape(dim1))
-            Op_blocks.append(np.concatenate(Op_blocks_col, axis=1))
+            Rhs_blocks.append(rhs.reshape(-1))
            
-        Op = np.concatenate(Op_blocks, axis=0)
         Rhs = np.concatenate(Rhs_blocks, axis=0)
         Res = np.linalg.solve(Op, Rhs)
         #Res, *_ = np.linalg.lstsq(Op, self.values, rcond=None)  # When Op.T@Op is singular (less samples then dofs in this component) then lstsq returns the minimal norm solution.
-        core[...] = BlockSparseTensor(Res, coreBlocks, core.shape).toarray()
+        self.bstt.set_component(self.bstt.corePosition, Res)
 
         if self.verbosity >= 2:
             print(f"microstep.  (residual: {pre_res:.2e} --> {self.residual():.2e})")
@@ -464,6 +767,8 @@ class ALSGrad(object):
             while self.bstt.corePosition > 0:
                 self.microstep()
                 self.move_core('left')
+            if self.bstt.verifyLevel != 'off':
+                self.bstt.verify()
 
             residual = self.residual()
             if self.verbosity >= 1: print(f"[{sweep}] Residuum: {residual:.2e}")
@@ -498,8 +803,7 @@ class ALSSystem(object):
     def __init__(self, _bstt, _measurements, _values, _localL2Gramians=None, _localH1Gramians=None, _maxGroupSize=3, _verbosity=0):
         self.bstt = _bstt
         assert isinstance(_bstt, BlockSparseTTSystem)
-        assert isinstance(_measurements, np.ndarray) and isinstance(
-            _values, np.ndarray)
+        assert isinstance(_values, np.ndarray)
         assert _maxGroupSize > 0
         assert len(_measurements) == self.bstt.order
         assert all(compMeas.shape == (len(_values), dim)
@@ -717,6 +1021,8 @@ class ALSSystem(object):
             while self.bstt.corePosition > 0:
                 self.microstep()
                 self.move_core('left')
+            if self.bstt.verifyLevel != 'off':
+                self.bstt.verify()
             residual = self.residual()
             if self.verbosity >= 1:
                 print(f"[{sweep}] Residuum: {residual:.2e}, Norm: {np.linalg.norm(self.bstt.components[self.bstt.corePosition])}, alpha = {self.alpha}")
@@ -755,8 +1061,7 @@ class ALSSystem2(object):
     def __init__(self, _coeffs, _measurements, _values, _verbosity=0):
         self.coeffs = _coeffs
         assert isinstance(_coeffs, BlockSparseTTSystem2)
-        assert isinstance(_measurements, np.ndarray) and isinstance(
-            _values, np.ndarray)
+        assert isinstance(_values, np.ndarray)
         assert len(_measurements) == self.coeffs.order
         assert all(compMeas.shape == (len(_values), dim)
                    for compMeas, dim in zip(_measurements, self.coeffs.dimensions))
@@ -770,11 +1075,22 @@ class ALSSystem2(object):
         self.targetResidual = 1e-8
         self.minDecrease = 1e-3
         self.alpha = 0.1
-
-        self.leftStack = [[np.ones((self.numberOfSamples, 1))] *
+        self.method = 'l2'
+        self.chunkSize = 10000  # number of samples per chunk for method 'l2gram'
+        self.numberOfWorkers = 1  # number of threads that process the chunks for method 'l2gram'
+        self.executor = None  # executor (e.g. ThreadPoolExecutor or ProcessPoolExecutor) for the independent solves of the cores in microstep
+        self.stackExecutor = None  # ThreadPoolExecutor for the stack contractions in move_core (a process pool would copy the BlockSparseTT and the stack for every contraction)
+        self.chunkExecutor = None  # thread pool for the chunks of method 'l2gram' (created and shut down by run)
+        self.stackDtype = np.float64  # dtype of the left and right stacks (the local problems are always solved in float64)
+        self.startSweep = 0  # index of the first sweep of run (set by resume)
+        self.residuals = []  # residual history: the initial residual and the residual after every sweep
+        self.checkpointFile = None  # if set, run writes a checkpoint (see write_checkpoint) to this file
+        self.checkpointInterval = 1  # number of sweeps between two checkpoints
+
+        self.leftStack = [[np.ones((self.numberOfSamples, 1), dtype=self.stackDtype)] *
                           self.coeffs.numberOfEquations] + [None]*(self.coeffs.order-1)
         self.rightStack = [
-            [np.ones((self.numberOfSamples, 1))]*self.coeffs.numberOfEquations]
+            [np.ones((self.numberOfSamples, 1), dtype=self.stackDtype)]*self.coeffs.numberOfEquations]
 
         self.coeffs.assume_corePosition(self.coeffs.order-1)
         self.direction = 'left'
@@ -789,25 +1105,13 @@ class ALSSystem2(object):
         self.coeffs.move_core(self.direction)
         if self.direction == 'left':
             self.leftStack.pop()
-            newStack = []
-            for eq in range(self.coeffs.numberOfEquations):
-                comp = self.coeffs.bstts[self.coeffs.selectionMatrix[eq,
-                        self.coeffs.corePosition+1]].components[self.coeffs.corePosition+1]
-                newStack.append(np.einsum('ler, me, mr -> ml', comp,
-                                self.measurements[self.coeffs.corePosition+1], self.rightStack[-1][eq]))
-            self.rightStack.append(newStack)
+            self.rightStack.append(self.extend_stack(self.coeffs.corePosition+1, self.rightStack[-1], 'left'))
             if self.verbosity >= 2:
                 print(
                     f"move_core {self.coeffs.corePosition+1} --> {self.coeffs.corePosition}. ")
         elif self.direction == 'right':
             self.rightStack.pop()
-            newStack = []
-            for eq in range(self.coeffs.numberOfEquations):
-                comp = self.coeffs.bstts[self.coeffs.selectionMatrix[eq,
-                        self.coeffs.corePosition-1]].components[self.coeffs.corePosition-1]
-                newStack.append(np.einsum(
-                    'ml, me, ler -> mr', self.leftStack[-1][eq], self.measurements[self.coeffs.corePosition-1], comp))
-            self.leftStack.append(newStack)
+            self.leftStack.append(self.extend_stack(self.coeffs.corePosition-1, self.leftStack[-1], 'right'))
             if self.verbosity >= 2:
                 print(
                     f"move_core {self.coeffs.corePosition-1} --> {self.coeffs.corePosition}.")
@@ -815,16 +1119,64 @@ class ALSSystem2(object):
             raise ValueError(
                 f"Unknown _direction. Expected 'left' or 'right' but got '{self.direction}'")
 
+    def extend_stack(self, _position, _stack, _direction):
+        """
+        Contract the stacks `_stack` of all equations with the component that they select at `_position`.
+        For `_direction == 'left'` these are right stacks and for `_direction == 'right'` left stacks.
+
+        Equations that select the same component and have the same (identical) stack share the result.
+        Only the distinct contractions are computed (on `self.stackExecutor`, if it is given).
+        Hence the stacks of equations with the same prefix (suffix) in the selection matrix are stored only once,
+        unless they were changed by a basis transformation in microstep. Stacks must therefore never be modified in place.
+        """
+        assert self.stackExecutor is None or isinstance(self.stackExecutor, ThreadPoolExecutor)
+        E = self.measurements[_position]
+        keys = list(dict.fromkeys((self.coeffs.selectionMatrix[eq, _position], id(_stack[eq])) for eq in range(self.coeffs.numberOfEquations)))
+        stacks = {id(stack): stack for stack in _stack}
+        args = ([self.coeffs.bstts[sel] for sel, _ in keys], [_position]*len(keys), [stacks[stackId] for _, stackId in keys],
+                [E]*len(keys), [_direction]*len(keys))
+        results = dict(zip(keys, (map if self.stackExecutor is None else self.stackExecutor.map)(contract_stack, *args)))
+        return [results[self.coeffs.selectionMatrix[eq, _position], id(_stack[eq])] for eq in range(self.coeffs.numberOfEquations)]
+
+    def rebuild_stacks(self):
+        """
+        Recompute the left and right stacks for the current core position in `self.stackDtype`.
+        """
+        ones = np.ones((self.numberOfSamples, 1), dtype=self.stackDtype)
+        self.leftStack = [[ones]*self.coeffs.numberOfEquations]
+        for k in range(self.coeffs.corePosition):
+            self.leftStack.append(self.extend_stack(k, self.leftStack[-1], 'right'))
+        self.rightStack = [[ones]*self.coeffs.numberOfEquations]
+        for k in reversed(range(self.coeffs.corePosition+1, self.coeffs.order)):
+            self.rightStack.append(self.extend_stack(k, self.rightStack[-1], 'left'))
+
+    def resume(self, _checkpointFile):
+        """
+        Restore the coefficients, the number of finished sweeps and the residual history from a checkpoint written by `run`.
+
+        The stacks are rebuilt, so a subsequent call of `run` continues with the next sweep.
+        """
+        bstts, sweep, residuals = read_checkpoint(_checkpointFile)
+        assert len(bstts) == self.coeffs.numberOfInteractions
+        for bstt, data in zip(self.coeffs.bstts, bstts):
+            load_checkpoint_data(bstt, *data)
+        self.coeffs.blocks = self.coeffs.bstts[0].blocks
+        self.coeffs.assume_corePosition(self.coeffs.bstts[0].corePosition)
+        self.startSweep = sweep
+        self.residuals = residuals
+        self.rebuild_stacks()
+
     def residual(self):
         pred = []
+        contractions = {}
         for eq in range(self.coeffs.numberOfEquations):
-            core = self.coeffs.bstts \
-                    [self.coeffs.selectionMatrix[eq, self.coeffs.corePosition]] \
-                    .components[self.coeffs.corePosition]
+            sel = self.coeffs.selectionMatrix[eq, self.coeffs.corePosition]
             L = self.leftStack[-1][eq]
             E = self.measurements[self.coeffs.corePosition]
             R = self.rightStack[-1][eq]
-            pred.append(np.einsum('ler,ml,me,mr -> m', core, L, E, R))
+            if (sel, id(L)) not in contractions:
+                contractions[sel, id(L)] = self.coeffs.bstts[sel].contract_left(self.coeffs.corePosition, L.astype(np.float64, copy=False), E)
+            pred.append(np.einsum('mr,mr -> m', contractions[sel, id(L)], R))
         pred = np.column_stack(pred)
         return np.linalg.norm(pred.reshape(-1) - self.values.reshape(-1)) / np.linalg.norm(self.values.reshape(-1))
 
@@ -834,170 +1186,218 @@ class ALSSystem2(object):
         R = self.rightStack[-1]
         coreBlocks = self.coeffs.blocks[self.coeffs.corePosition]
 
-        # Build for each equation the corresponding local operator
-        Op_eq = []
+        # Equations with identical stacks (see extend_stack) have the same local operator.
+        stackGroups = {}
         for eq in range(self.coeffs.numberOfEquations):
-            Op_blocks_eq = []
-            for block in coreBlocks:
-                op = np.einsum(
-                    'ml,me,mr -> mler', L[eq][:, block[0]], E[:, block[1]], R[eq][:, block[2]])
-                Op_blocks_eq.append(op.reshape(self.numberOfSamples, -1))
-            Op_eq.append(np.concatenate(Op_blocks_eq, axis=1))
+            stackGroups.setdefault((id(L[eq]), id(R[eq])), []).append(eq)
+
+        # The local problems are always assembled and solved in float64.
+        doubles = {}
+        for stack in L + R:
+            if id(stack) not in doubles:
+                doubles[id(stack)] = stack.astype(np.float64, copy=False)
+        L = [doubles[id(stack)] for stack in L]
+        R = [doubles[id(stack)] for stack in R]
+        E = np.asarray(E, dtype=np.float64)
+
+        if self.method == 'l2':
+            # Build for each equation the corresponding local operator
+            Op_eq = [None]*self.coeffs.numberOfEquations
+            for group in stackGroups.values():
+                eq = group[0]
+                Op_blocks_eq = []
+                for block in coreBlocks:
+                    op = np.einsum(
+                        'ml,me,mr -> mler', L[eq][:, block[0]], E[:, block[1]], R[eq][:, block[2]])
+                    Op_blocks_eq.append(op.reshape(self.numberOfSamples, -1))
+                Op = np.concatenate(Op_blocks_eq, axis=1)
+                for eq in group:
+                    Op_eq[eq] = Op
+        else:
+            assert self.method == 'l2gram', "No valid method chosen, methods are l2 or l2gram"
+            # Build for each equation the normal equations of its local operator (only when they are needed).
+            # Stacking the operators of several equations corresponds to summing their Gram matrices and right hand sides.
+            Gram_eq = {}
+            groupOf = {eq: group for group in stackGroups.values() for eq in group}
+
+        def local_problem(_eqs):
+            # Return the least squares problem for the equations in `_eqs` as (solver, arguments).
+            if self.method == 'l2':
+                Op_eq_aux = []
+                for i in range(len(_eqs)):
+                    if _eqs[i]:
+                        Op_eq_aux.append(Op_eq[i])
+
+                Op = np.concatenate(Op_eq_aux, axis=0)
+
+                rhs = self.values[:, _eqs].reshape(-1, order='F')
+                #Res = np.linalg.solve(Op.T@Op+self.alpha*np.eye(Op.shape[1]), Op.T@rhs)
+                return solve_least_squares, (Op, rhs)
+            gram, rhs = 0, 0
+            for eq in np.where(_eqs)[0]:
+                if eq not in Gram_eq:
+                    group = groupOf[eq]
+                    groupGram, groupRhs = local_gram_system(L[eq], E, R[eq], coreBlocks, self.values[:, group], self.chunkSize, self.chunkExecutor)
+                    for j, e in enumerate(group):
+                        Gram_eq[e] = (groupGram, groupRhs[:, j])
+                gram, rhs = gram + Gram_eq[eq][0], rhs + Gram_eq[eq][1]
+            return solve_gram_system, (gram, rhs)
         
         # Optimize interaction range many cores
-        used = []
+        # Determine for each core the equations that are used to compute its new component.
+        # These least squares problems are independent of each other and are solved concurrently if an executor is given.
+        # The basis transformations modify the stacks and the neighbouring components and are performed after all solves.
+        cases = []
         for k in range(self.coeffs.interactions):
-            core = self.coeffs.bstts[k].components[self.coeffs.corePosition]
             eqs = [True if self.coeffs.selectionMatrix[eq, self.coeffs.corePosition]
                    == k else False for eq in range(self.coeffs.numberOfEquations)]
             if sum(eqs) == 0: continue # skip if core is not used at the current position  
             if sum(eqs) == 1 or (self.direction == 'right' and k == self.coeffs.interactions-1 and self.coeffs.corePosition > 0) or  (self.direction == 'left' and k == 0 and self.coeffs.corePosition < self.coeffs.order-1):
-                used.append('first')              
-                Op_eq_aux = []
-                for i in range(len(eqs)):
-                    if eqs[i]:
-                        Op_eq_aux.append(Op_eq[i])
-                
-                Op = np.concatenate(Op_eq_aux, axis=0)
-    
-                rhs = self.values[:, eqs].reshape(-1, order='F')
-                Res, *_ = np.linalg.lstsq(Op, rhs, rcond=None)
-                #Res = np.linalg.solve(Op.T@Op+self.alpha*np.eye(Op.shape[1]), Op.T@rhs)
-                core[:, :, :] = BlockSparseTensor(
-                    Res, coreBlocks, core.shape).toarray()
+                cases.append((k, 'first', eqs, eqs))
             elif (self.direction == 'right' and k == 0) or (self.direction == 'left' and k == 0 and self.coeffs.corePosition == self.coeffs.order-1): 
-                used.append('second')            
-
                 eqs2 = [True if self.coeffs.selectionMatrix[eq, self.coeffs.corePosition-1]
                        == k else False for eq in range(self.coeffs.numberOfEquations)]
+                cases.append((k, 'second', eqs, eqs2))
+            elif self.direction == 'left' and k == self.coeffs.interactions-1 or (self.direction == 'right' and k ==  self.coeffs.interactions-1 and self.coeffs.corePosition ==0): 
+                eqs2 = [True if self.coeffs.selectionMatrix[eq, self.coeffs.corePosition+1]
+                       == k else False for eq in range(self.coeffs.numberOfEquations)]
+                cases.append((k, 'third', eqs, eqs2))
+
+        # solve for coefficents for multiple equations
+        results = []
+        for k, case, eqs, eqs2 in cases:
+            solver, args = local_problem(eqs2)
+            results.append(solver(*args) if self.executor is None else self.executor.submit(solver, *args))
+
+        used = []
+        for (k, case, eqs, eqs2), Res in zip(cases, results):
+            if self.executor is not None:
+                Res = Res.result()
+            used.append(case)
+            bstt = self.coeffs.bstts[k]
+            shape = bstt.components[self.coeffs.corePosition].shape
+            bstt.set_component(self.coeffs.corePosition, Res)
+            if case == 'second':
                 diff = np.array(eqs) == np.array(eqs2)
                 switched_eqs = np.where(diff == diff.min())[0]
                 blocks_switched_eq =  list(set([Block((b[0], b[0])) for b in coreBlocks]))
 
-                # solve for coefficents for multiple equations
-                Op_eq_aux = []
-                for i in range(len(eqs2)):
-                    if eqs2[i]:
-                        Op_eq_aux.append(Op_eq[i])
-                
-                Op = np.concatenate(Op_eq_aux, axis=0)
-    
-                rhs = self.values[:, eqs2].reshape(-1, order='F')
-                Res, *_ = np.linalg.lstsq(Op, rhs, rcond=None)
-                #Res = np.linalg.solve(Op.T@Op+self.alpha*np.eye(Op.shape[1]), Op.T@rhs)
-                core[:, :, :] = BlockSparseTensor(
-                    Res, coreBlocks, core.shape).toarray()
-                
                 # find basistransformation to reuse coefficents
+                # (The stacks are read from self.leftStack and self.rightStack since they may have been transformed by a previous case.)
                 for switched_eq in switched_eqs:
-                    R_new = np.einsum('ler, me, mr -> ml', core,
-                                    self.measurements[self.coeffs.corePosition], R[switched_eq])
+                    L_switched_eq = self.leftStack[-1][switched_eq].astype(np.float64, copy=False)
+                    R_switched_eq = self.rightStack[-1][switched_eq].astype(np.float64, copy=False)
+                    R_new = bstt.contract_right(self.coeffs.corePosition, R_switched_eq,
+                                    self.measurements[self.coeffs.corePosition])
                     Op_blocks_switched_eq = []
                     for block in blocks_switched_eq:
                         op = np.einsum(
-                            'ml,mr -> mlr', L[switched_eq][:, block[0]], R_new[:, block[1]])
+                            'ml,mr -> mlr', L_switched_eq[:, block[0]], R_new[:, block[1]])
                         Op_blocks_switched_eq.append(op.reshape(self.numberOfSamples, -1))
                     Op_switched_eq = np.concatenate(Op_blocks_switched_eq, axis=1)
                     rhs_switched_eq = self.values[:, switched_eq].reshape(-1, order='F')
                     Res_switched_eq, *_ = np.linalg.lstsq(Op_switched_eq, rhs_switched_eq, rcond=None)
                     core_switched_eq = BlockSparseTensor(
-                        Res_switched_eq,  blocks_switched_eq, (core.shape[0], core.shape[0])).toarray()
+                        Res_switched_eq,  blocks_switched_eq, (shape[0], shape[0])).toarray()
                     self.leftStack[-1][switched_eq] = np.einsum(
-                       'ml, lr -> mr', self.leftStack[-1][switched_eq], core_switched_eq)
-                    comp =  self.coeffs.bstts[ self.coeffs.selectionMatrix[switched_eq, 
-                        self.coeffs.corePosition-1]].components[self.coeffs.corePosition-1]
-                    self.coeffs.bstts[ self.coeffs.selectionMatrix[switched_eq, 
-                        self.coeffs.corePosition-1]].components[self.coeffs.corePosition-1] = \
-                        np.einsum('ler,rs->les',comp,core_switched_eq)
-            elif self.direction == 'left' and k == self.coeffs.interactions-1 or (self.direction == 'right' and k ==  self.coeffs.interactions-1 and self.coeffs.corePosition ==0): 
-                used.append('third')              
-                eqs2 = [True if self.coeffs.selectionMatrix[eq, self.coeffs.corePosition+1]
-                       == k else False for eq in range(self.coeffs.numberOfEquations)]
+                       'ml, lr -> mr', self.leftStack[-1][switched_eq], core_switched_eq).astype(self.stackDtype, copy=False)
+                    self.coeffs.bstts[self.coeffs.selectionMatrix[switched_eq, self.coeffs.corePosition-1]] \
+                        .modeproduct(self.coeffs.corePosition-1, core_switched_eq, 2)
+            elif case == 'third':
                 diff = np.array(eqs) == np.array(eqs2)
                 switched_eqs = np.where(diff == diff.min())[0] 
                 blocks_switched_eq =  list(set([Block((b[2], b[2])) for b in coreBlocks]))
-                
-                # solve for coefficents for multiple equations
-                Op_eq_aux = []
-                for i in range(len(eqs2)):
-                    if eqs2[i]:
-                        Op_eq_aux.append(Op_eq[i])
-                
-                Op = np.concatenate(Op_eq_aux, axis=0)
-    
-                rhs = self.values[:, eqs2].reshape(-1, order='F')
-                Res, *_ = np.linalg.lstsq(Op, rhs, rcond=None)
-                #Res = np.linalg.solve(Op.T@Op+self.alpha*np.eye(Op.shape[1]), Op.T@rhs)
-                core[:, :, :] = BlockSparseTensor(
-                    Res, coreBlocks, core.shape).toarray()
-                
+
                 # find basistransformation to reuse coefficents
                 for switched_eq in switched_eqs:
- 
-                    L_new = np.einsum( 'ml, me, ler -> mr', L[switched_eq], 
-                                      self.measurements[self.coeffs.corePosition], core)
+                    L_switched_eq = self.leftStack[-1][switched_eq].astype(np.float64, copy=False)
+                    R_switched_eq = self.rightStack[-1][switched_eq].astype(np.float64, copy=False)
+                    L_new = bstt.contract_left(self.coeffs.corePosition, L_switched_eq,
+                                      self.measurements[self.coeffs.corePosition])
                     Op_blocks_switched_eq = []
                     for block in blocks_switched_eq:
                         op = np.einsum(
-                            'ml,mr -> mlr', L_new[:, block[0]], R[switched_eq][:, block[1]])
+                            'ml,mr -> mlr', L_new[:, block[0]], R_switched_eq[:, block[1]])
                         Op_blocks_switched_eq.append(op.reshape(self.numberOfSamples, -1))
                     Op_switched_eq = np.concatenate(Op_blocks_switched_eq, axis=1)
                     rhs_switched_eq = self.values[:, switched_eq].reshape(-1, order='F')
                     Res_switched_eq, *_ = np.linalg.lstsq(Op_switched_eq, rhs_switched_eq, rcond=None)
                     core_switched_eq = BlockSparseTensor(
-                        Res_switched_eq,  blocks_switched_eq, (core.shape[2], core.shape[2])).toarray()
+                        Res_switched_eq,  blocks_switched_eq, (shape[2], shape[2])).toarray()
                     self.rightStack[-1][switched_eq] = np.einsum(
-                       'lr, mr -> ml', core_switched_eq,self.rightStack[-1][switched_eq])
-                    comp =  self.coeffs.bstts[ self.coeffs.selectionMatrix[switched_eq, 
-                        self.coeffs.corePosition+1]].components[self.coeffs.corePosition+1]
-                    self.coeffs.bstts[ self.coeffs.selectionMatrix[switched_eq, 
-                        self.coeffs.corePosition+1]].components[self.coeffs.corePosition+1] = \
-                        np.einsum('kl,ler->ker',core_switched_eq,comp)
-                    
-        self.coeffs.verify()
+                       'lr, mr -> ml', core_switched_eq,self.rightStack[-1][switched_eq]).astype(self.stackDtype, copy=False)
+                    self.coeffs.bstts[self.coeffs.selectionMatrix[switched_eq, self.coeffs.corePosition+1]] \
+                        .modeproduct(self.coeffs.corePosition+1, core_switched_eq.T, 0)
+
+        self.coeffs.verify_update(range(max(self.coeffs.corePosition-1, 0), min(self.coeffs.corePosition+2, self.coeffs.order)))
         if self.verbosity >= 2:
             print(
                 f"microstep.  (residual: {self.prev_residual:.2e} --> {self.residual():.2e}), Direction {self.direction}, Core {self.coeffs.corePosition}, used {used}, interaction {self.coeffs.interactions}")
 
     def run(self):
-        self.prev_residual = self.residual()
-        if self.verbosity >= 1:
-            print(f"Initial residuum: {self.prev_residual:.2e}")
-        for sweep in range(self.maxSweeps):
-            self.direction = 'right'
-            while self.coeffs.corePosition < self.coeffs.order-1:
-                self.microstep()
-                self.move_core()
-            self.direction = 'left'
-            while self.coeffs.corePosition > 0:
-                self.microstep()
-                self.move_core()
-            self.microstep()
-            residual = self.residual()
+        if self.method == 'l2gram' and self.numberOfWorkers > 1:
+            self.chunkExecutor = ThreadPoolExecutor(self.numberOfWorkers)
+        try:
+            if self.leftStack[0][0].dtype != self.stackDtype:
+                self.rebuild_stacks()
+            self.prev_residual = self.residual()
+            if not self.residuals:
+                self.residuals.append(self.prev_residual)
             if self.verbosity >= 1:
-                print(f"[{sweep}] Residuum: {residual:.2e}")
-
-            if residual < self.targetResidual:
-                if self.verbosity >= 1:
-                    print(f"Terminating (targetResidual reached)")
-                    print(f"Final residuum: {self.residual():.2e}")
-                return
-
-            if residual > self.prev_residual and sweep > 0:
-                if self.verbosity >= 1:
-                    print(f"Terminating (residual increases)")
-                    print(f"Final residuum: {self.residual():.2e}")
-                return
-
-            if (self.prev_residual - residual) < self.minDecrease*residual and sweep > 0:
+                print(f"Initial residuum: {self.prev_residual:.2e}")
+            for sweep in range(self.startSweep, self.maxSweeps):
+                self.direction = 'right'
+                while self.coeffs.corePosition < self.coeffs.order-1:
+                    self.microstep()
+                    self.move_core()
+                self.direction = 'left'
+                while self.coeffs.corePosition > 0:
+                    self.microstep()
+                    self.move_core()
+                self.microstep()
+                if self.coeffs.verifyLevel != 'off':
+                    self.coeffs.verify()
+                residual = self.residual()
+                self.residuals.append(residual)
                 if self.verbosity >= 1:
-                    print(f"Terminating (minDecrease reached)")
-                    print(f"Final residuum: {self.residual():.2e}")
-                return
+                    print(f"[{sweep}] Residuum: {residual:.2e}")
+                if self.checkpointFile is not None and (sweep+1) % self.checkpointInterval == 0:
+                    write_checkpoint(self.checkpointFile, self.coeffs.bstts, sweep+1, self.residuals)
+
+                if residual < self.targetResidual:
+                    if self.verbosity >= 1:
+                        print(f"Terminating (targetResidual reached)")
+                        print(f"Final residuum: {self.residual():.2e}")
+                    return
+
+                if (residual > self.prev_residual or (self.prev_residual - residual) < self.minDecrease*residual) and sweep > 0 and np.dtype(self.stackDtype) != np.float64:
+                    # The stagnation may be caused by the reduced precision of the stacks.
+                    if self.verbosity >= 1:
+                        print(f"Switching to float64 stacks (convergence stalls with {np.dtype(self.stackDtype).name})")
+                    self.stackDtype = np.float64
+                    self.rebuild_stacks()
+                    self.prev_residual = residual
+                    continue
+
+                if residual > self.prev_residual and sweep > 0:
+                    if self.verbosity >= 1:
+                        print(f"Terminating (residual increases)")
+                        print(f"Final residuum: {self.residual():.2e}")
+                    return
+
+                if (self.prev_residual - residual) < self.minDecrease*residual and sweep > 0:
+                    if self.verbosity >= 1:
+                        print(f"Terminating (minDecrease reached)")
+                        print(f"Final residuum: {self.residual():.2e}")
+                    return
+
+                self.prev_residual = residual
 
-            self.prev_residual = residual
-
-        if self.verbosity >= 1:
-            print(f"Terminating (maxSweeps reached)")
-        if self.verbosity >= 1:
-            print(f"Final residuum: {self.residual():.2e}")
+            if self.verbosity >= 1:
+                print(f"Terminating (maxSweeps reached)")
+            if self.verbosity >= 1:
+                print(f"Final residuum: {self.residual():.2e}")
+        finally:
+            if self.chunkExecutor is not None:
+                self.chunkExecutor.shutdown()
+                self.chunkExecutor = None
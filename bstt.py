@@ -1,6 +1,5 @@
 from math import comb
 import numpy as np
-from scipy.sparse import block_diag, diags
 
 
 class Block(tuple):
@@ -26,7 +25,7 @@ class Block(tuple):
 
     @property
     def size(self):
-        return np.product(self.shape)
+        return np.prod(self.shape)
 
     @property
     def shape(self):
@@ -62,23 +61,117 @@ class Block(tuple):
 
 
 
-class BlockSparseTensor(object):
-    def __init__(self, _data, _blocks, _shape):
-        assert isinstance(_data, np.ndarray) and _data.ndim == 1
-        self.data = _data
-        assert isinstance(_blocks, (list, tuple))
-        self.blocks = [Block(block) for block in _blocks]
+class BlockPlan(object):
+    """
+    Index information for a list of blocks in a tensor of a given shape.
+
+    The structure of the blocks is validated only once, when the plan is created.
+    Plans are cached by `BlockPlan.get` and shared by all BlockSparseTensors with the same blocks and shape.
+    """
+    maxCacheSize = 4096
+    __cache = {}
+
+    def __init__(self, _blocks, _shape):
+        self.blocks = _blocks
         self.shape = _shape
+        assert isinstance(self.shape, tuple) and np.all(np.array(self.shape) > 0)
         shapeBlock = Block(slice(0,dim,1) for dim in self.shape)
         assert all(shapeBlock.contains(block) for block in self.blocks)
-        assert sum(block.size for block in self.blocks) == self.data.size
         for i in range(len(self.blocks)):
             for j in range(i):
                 assert self.blocks[i].disjoint(self.blocks[j]) and self.blocks[i].coherent(self.blocks[j])
-        assert isinstance(self.shape, tuple) and np.all(np.array(self.shape) > 0)
+        self.offsets = np.cumsum([0] + [block.size for block in self.blocks]).tolist()
+        self.dofs = self.offsets[-1]
+        # The position of the packed data in the flattened (dense) tensor.
+        indices = np.arange(np.prod(self.shape)).reshape(self.shape)
+        self.indices = np.concatenate([indices[block].reshape(-1) for block in self.blocks])
+        self.complement = np.setdiff1d(indices.reshape(-1), self.indices, assume_unique=True)
+        self.__modeGroups = {}
+
+    @classmethod
+    def get(cls, _blocks, _shape):
+        key = (tuple(_blocks), tuple(_shape))
+        plan = cls.__cache.get(key)
+        if plan is None:
+            if len(cls.__cache) >= cls.maxCacheSize:
+                cls.__cache.clear()
+            plan = cls.__cache[key] = cls(*key)
+        return plan
+
+    def residue(self, _array):
+        """
+        Return the entries of `_array` that do not lie in any block.
+        """
+        assert _array.shape == self.shape
+        return _array.reshape(-1)[self.complement]
+
+    def mode_groups(self, _mode):
+        """
+        Group the blocks by their slices in the `_mode`-th mode.
+
+        Returns the sorted list of pairs `(slc, idcs)` where `slc` is a slice of the `_mode`-th mode and `idcs` are the indices of all blocks with this slice.
+        """
+        if _mode not in self.__modeGroups:
+            mSlices = sorted({(block[_mode].start, block[_mode].stop) for block in self.blocks})  #NOTE: slices are not hashable.
+
+            # Check if the block structure can be retained.
+            # It is necessary that there are no slices in the matricisation that are necessarily zero due to the block structure.
+            assert mSlices[0][0] == 0, f"Hole found in mode {_mode}: (0:{mSlices[0][0]})"
+            for j in range(len(mSlices)-1):
+                assert mSlices[j][1] == mSlices[j+1][0], f"Hole found in mode {_mode}: ({mSlices[j][1]}:{mSlices[j+1][0]})"
+            assert mSlices[-1][1] == self.shape[_mode], f"Hole found in mode {_mode}: ({mSlices[-1][1]}:{self.shape[_mode]})"
+
+            #NOTE: For coherent blocks blk[_mode].start == slc[0] implies equality of the slice.
+            self.__modeGroups[_mode] = [(slice(*slc), [e for e, blk in enumerate(self.blocks) if blk[_mode].start == slc[0]]) for slc in mSlices]
+        return self.__modeGroups[_mode]
+
+
+class BlockSparseTensor(object):
+    def __init__(self, _data, _blocks, _shape):
+        assert isinstance(_data, np.ndarray) and _data.ndim == 1
+        self.data = _data
+        assert isinstance(_blocks, (list, tuple))
+        self.blocks = [block if isinstance(block, Block) else Block(block) for block in _blocks]
+        self.shape = _shape
+        self.plan = BlockPlan.get(self.blocks, self.shape)
+        assert self.plan.dofs == self.data.size
 
     def dofs(self):
-        return sum(blk.size for blk in self.blocks)
+        return self.plan.dofs
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def items(self):
+        """
+        Iterate over the pairs `(block, values)` of all non-zero blocks.
+
+        `values` is a view of the packed data of `block`, reshaped to `block.shape`.
+        """
+        slices = self.plan.offsets
+        for e,block in enumerate(self.blocks):
+            yield block, self.data[slices[e]:slices[e+1]].reshape(block.shape)
+
+    def modeproduct(self, _matrix, _mode):
+        """
+        Contract the `_mode`-th mode of the tensor with the first mode of `_matrix`.
+
+        The result is computed block by block and is only well-defined if `_matrix` is block diagonal with respect to the
+        slices of the `_mode`-th mode. Then the block structure is retained.
+        """
+        assert _matrix.shape == (self.shape[_mode], self.shape[_mode])
+        mSlices = {(block[_mode].start, block[_mode].stop) for block in self.blocks}
+        test = np.array(_matrix, copy=True)
+        for slc in mSlices:
+            test[slice(*slc), slice(*slc)] = 0
+        assert np.allclose(test, 0), f"Matrix is not block diagonal with respect to the slices of mode {_mode}."
+        data = []
+        for block, values in self.items():
+            slc = block[_mode]
+            values = np.moveaxis(np.tensordot(values, _matrix[slc, slc], axes=(_mode, 0)), -1, _mode)
+            data.append(values.reshape(-1))
+        return BlockSparseTensor(np.concatenate(data), self.blocks, self.shape)
 
     def svd(self, _mode):
         """
@@ -86,6 +179,8 @@ class BlockSparseTensor(object):
 
         The considered matricisation has `_mode` as its rows and all other modes as its columns.
         If `U,S,Vt = X.svd(_mode)`, then `X == (U @ S) @[_mode] Vt` where `@[_mode]` is the contraction with the `_mode`-th mode ov Vt.
+        U is returned as a block diagonal BlockSparseTensor of order 2, S as the vector of singular values and Vt as a
+        BlockSparseTensor with the same blocks as X.
         """
         # SVD for _mode == 0
         # ==================
@@ -122,82 +217,63 @@ class BlockSparseTensor(object):
         # terms of the matrification of X.
         #
         # Note that this prove is constructive and provides a performant and numerically stable way to compute the SVD.
-        #TODO: This can be done more efficiently.
-
-        mSlices = sorted({(block[_mode].start, block[_mode].stop) for block in self.blocks})  #NOTE: slices are not hashable.
-
-        # Check if the block structure can be retained.
-        # It is necessary that there are no slices in the matricisation that are necessarily zero due to the block structure.
-        assert mSlices[0][0] == 0, f"Hole found in mode {_mode}: (0:{mSlices[0][0]})"
-        for j in range(len(mSlices)-1):
-            assert mSlices[j][1] == mSlices[j+1][0], f"Hole found in mode {_mode}: ({mSlices[j][1]}:{mSlices[j+1][0]})"
-        assert mSlices[-1][1] == self.shape[_mode], f"Hole found in mode {_mode}: ({mSlices[-1][1]}:{self.shape[_mode]})"
-        # After matricisation the SVD is performed for each row-slice individually.
-        # To ensure that the block structure is maintained the non-zero columns must outnumber the non-zero rows.
-        for slc in mSlices:
-            rows = slc[1]-slc[0]
-            cols = sum(Block(blk).size for blk in self.blocks if blk[_mode].start == slc[0])     #NOTE: For coherent blocks blk[0].start == slc[0] implies equality of the slice.
-            assert cols % rows == 0
-            cols //= rows  # cols is the number of all non-zero columns of the `slc`-slice of the matricisation.
-            assert rows <= cols, f"The {_mode}-matrification has too few non-zero columns (shape: {(rows, cols)}) for slice ({slc[0]}:{slc[1]})."  # of components[{m}][{reason[0].start}:{reason[0].stop}] has too few non-zero columns (rows: {reason[1][0]}, columns: {reason[1][1]})"
-
-        def notMode(_tuple):
-            return _tuple[:_mode] + _tuple[_mode+1:]
-
-        # Store the blocks of the `_mode`-matrification (interpreted as a BlockSparseTensor).
-        indices = np.arange(np.product(notMode(self.shape))).reshape(notMode(self.shape))
-        mBlocks = []
-        for slc in mSlices:
-            idcs = [indices[notMode(blk)].reshape(-1) for blk in self.blocks if blk[_mode].start == slc[0]]
-            idcs = np.sort(np.concatenate(idcs))
-            mBlocks.append((slice(*slc), idcs))
-
-        matricisation = np.moveaxis(self.toarray(), _mode, 0)
-        mShape = matricisation.shape
-        matricisation = matricisation.reshape(self.shape[_mode], -1)
+        # Since the non-zero columns of a row-slice are exactly the columns of the blocks in this row-slice, the matrix Y
+        # can be gathered directly from the packed data without forming the (dense) matricisation of X.
 
         # Compute the row-block-wise SVD.
-        U_blocks, S_blocks, Vt_blocks = [], [], []
-        for block in mBlocks:
-            u,s,vt = np.linalg.svd(matricisation[block], full_matrices=False)
-            assert u.shape[0] == u.shape[1]  #TODO: Handle the case that a singular value is zero.
-            U_blocks.append(u)
-            S_blocks.append(s)
-            Vt_blocks.append(vt)
-        U = block_diag(U_blocks, format='bsr')
-        S = diags([np.concatenate(S_blocks)], [0], format='dia')
-        Vt = np.zeros(matricisation.shape)
-        for block, Vt_block in zip(mBlocks, Vt_blocks):
-            Vt[block] = Vt_block
-
-        # Reshape Vt back into the original tensor shape.
-        Vt = np.moveaxis(Vt.reshape(mShape), 0, _mode)
-        #TODO: Is this equivalent to Vt = BlockSparseTensor(data, self.blocks, self.shape).toarray()?
-
+        # After matricisation the SVD is performed for each row-slice individually.
+        # If a row-slice has fewer non-zero columns than rows (e.g. after the neighbouring edge has been truncated),
+        # the missing singular values are zero and the corresponding rows of Vt vanish. Only in this case Vt is not orthogonal.
+        mGroups = self.plan.mode_groups(_mode)
+        blockValues = list(self.items())
+        Vt_data = [None]*len(self.blocks)
+        U_data, S = [], []
+        for slc, idcs in mGroups:
+            rows = slc.stop-slc.start
+            Y = [np.moveaxis(blockValues[e][1], _mode, 0).reshape(rows, -1) for e in idcs]
+            cols = np.cumsum([0] + [y.shape[1] for y in Y]).tolist()  # cols[-1] is the number of all non-zero columns of the `slc`-slice of the matricisation.
+            u,s,vt = np.linalg.svd(np.concatenate(Y, axis=1), full_matrices=rows > cols[-1])
+            if rows > cols[-1]:
+                s = np.concatenate([s, np.zeros(rows-cols[-1], dtype=s.dtype)])
+                vt = np.concatenate([vt, np.zeros((rows-cols[-1], cols[-1]), dtype=vt.dtype)], axis=0)
+            assert u.shape == (rows, rows) and vt.shape == (rows, cols[-1])
+            U_data.append(u.reshape(-1))
+            S.append(s)
+            for j, e in enumerate(idcs):
+                block = self.blocks[e]
+                vt_block = vt[:, cols[j]:cols[j+1]].reshape((rows,) + block.shape[:_mode] + block.shape[_mode+1:])
+                Vt_data[e] = np.moveaxis(vt_block, 0, _mode).reshape(-1)
+        U = BlockSparseTensor(np.concatenate(U_data), [Block((slc, slc)) for slc, _ in mGroups], (self.shape[_mode], self.shape[_mode]))
+        S = np.concatenate(S)
+        Vt = BlockSparseTensor(np.concatenate(Vt_data), self.blocks, self.shape)
         return U, S, Vt
 
     def toarray(self):
-        ret = np.zeros(self.shape)
-        slices = np.cumsum([0] + [block.size for block in self.blocks]).tolist()
-        for e,block in enumerate(self.blocks):
-            ret[block] = self.data[slices[e]:slices[e+1]].reshape(block.shape)
+        ret = np.zeros(self.shape, dtype=self.data.dtype)
+        ret.reshape(-1)[self.plan.indices] = self.data
         return ret
 
     @classmethod
     def fromarray(cls, _array, _blocks):
-        test = np.array(_array, copy=True)
-        for block in _blocks:
-            test[block] = 0
-        assert np.all(test == 0), f"Block structure and sparsity pattern do not match."
-        data = np.concatenate([_array[block].reshape(-1) for block in _blocks])
+        plan = BlockPlan.get([block if isinstance(block, Block) else Block(block) for block in _blocks], _array.shape)
+        data = _array.reshape(-1)[plan.indices]
+        # All non-zero entries of _array have to lie in the blocks.
+        assert np.count_nonzero(_array) == np.count_nonzero(data), f"Block structure and sparsity pattern do not match."
         return BlockSparseTensor(data, _blocks, _array.shape)
 
 
 class BlockSparseTT(object):
+    # When to check the block structure of the components:
+    #     'off'      --- never, except in the constructor and on explicit calls of `verify`
+    #     'sweep'    --- only when a solver finishes a sweep
+    #     'paranoid' --- after every modification (only the modified components are checked)
+    verifyLevel = 'paranoid'
+
     def __init__(self, _components, _blocks):
         """
-        _components : list of ndarrays of order 3
+        _components : list of ndarrays of order 3 or list of BlockSparseTensors of order 3
             The list of component tensors for the TTTensor.
+            If the components are given as BlockSparseTensors only the packed data of the non-zero blocks is stored (see `pack`).
         _blocks : list of list of triples
             For the k-th component tensor _blocks[k] contains the list of its blocks of non-zero values:
                 _blocks[k] --- list of non-zero blocks in the k-th component tensor
@@ -207,10 +283,9 @@ class BlockSparseTT(object):
             To obtain the block this triple the slice in the component tensor:
                 _blocks[k][l] --- The l-th non-zero block for the k-th component tensor.
                                   The coordinates are given by _components[k][_blocks[k][l]].
-
-        NOTE: Later we can remove _components and augment each triple in _blocks by an array that contains the data in this block.
         """
-        assert all(cmp.ndim == 3 for cmp in _components)
+        assert all(isinstance(cmp, np.ndarray) for cmp in _components) or all(isinstance(cmp, BlockSparseTensor) for cmp in _components)
+        assert all(len(cmp.shape) == 3 for cmp in _components)
         assert _components[0].shape[0] == 1
         assert all(cmp1.shape[2] == cmp2.shape[0] for cmp1,cmp2 in zip(_components[:-1], _components[1:]))
         assert _components[-1].shape[2] == 1
@@ -219,29 +294,217 @@ class BlockSparseTT(object):
         assert isinstance(_blocks, list) and len(_blocks) == self.order
 
         for m, (comp, compBlocks) in enumerate(zip(self.components, _blocks)):
-            BlockSparseTensor.fromarray(comp, compBlocks)
+            if isinstance(comp, np.ndarray):
+                BlockSparseTensor.fromarray(comp, compBlocks)
 
         self.blocks = _blocks
 
         self.__corePosition = None
         self.verify()
 
-    def verify(self):
-        for e, (compBlocks, component) in enumerate(zip(self.blocks, self.components)):
+    def verify(self, _positions=None):
+        """
+        Check that the components at `_positions` (default: all components) satisfy the block structure.
+        """
+        if _positions is None:
+            _positions = range(self.order)
+        for e in _positions:
+            compBlocks, component = self.blocks[e], self.components[e]
+            if isinstance(component, BlockSparseTensor):
+                # The block structure is satisfied by construction.
+                assert np.all(np.isfinite(component.data))
+                assert component.blocks == [Block(block) for block in compBlocks], f"Component {e} does not satisfy the block structure."
+                continue
             assert np.all(np.isfinite(component))
-            cmp = np.array(component)
-            for block in compBlocks:
-                cmp[block] = 0
-            assert np.allclose(cmp, 0), f"Component {e} does not satisfy the block structure. Error: {np.max(abs(cmp)):.2e}"
+            res = BlockPlan.get([Block(block) for block in compBlocks], component.shape).residue(component)
+            assert np.allclose(res, 0), f"Component {e} does not satisfy the block structure. Error: {np.max(abs(res), initial=0):.2e}"
+
+    def verify_update(self, _positions):
+        """
+        Check the modified components at `_positions` if `verifyLevel == 'paranoid'`.
+        """
+        assert self.verifyLevel in ['off', 'sweep', 'paranoid']
+        if self.verifyLevel == 'paranoid':
+            self.verify(_positions)
+
+    @property
+    def packed(self):
+        return isinstance(self.components[0], BlockSparseTensor)
+
+    def pack(self):
+        """
+        Store every component as a BlockSparseTensor, i.e. only keep the data of the non-zero blocks.
+        """
+        if not self.packed:
+            self.components = [BlockSparseTensor.fromarray(comp, blks) for comp, blks in zip(self.components, self.blocks)]
+
+    def unpack(self):
+        """
+        Store every component as a dense ndarray.
+        """
+        if self.packed:
+            self.components = [comp.toarray() for comp in self.components]
+
+    def dense_component(self, _position):
+        comp = self.components[_position]
+        if isinstance(comp, BlockSparseTensor):
+            return comp.toarray()
+        return comp
+
+    def packed_component(self, _position):
+        comp = self.components[_position]
+        if isinstance(comp, BlockSparseTensor):
+            return comp
+        return BlockSparseTensor.fromarray(comp, self.blocks[_position])
+
+    def set_component(self, _position, _data):
+        """
+        Replace the `_position`-th component.
+
+        `_data` is either a dense ndarray, a BlockSparseTensor or a vector that contains the data of the blocks in the order of `self.blocks[_position]`.
+        The component is stored in the current storage mode and keeps its dtype.
+        """
+        shape = self.components[_position].shape
+        dtype = self.components[_position].dtype
+        if isinstance(_data, BlockSparseTensor):
+            _data = BlockSparseTensor(_data.data.astype(dtype, copy=False), _data.blocks, _data.shape)
+        elif isinstance(_data, np.ndarray):
+            _data = _data.astype(dtype, copy=False)
+        if isinstance(_data, np.ndarray) and _data.ndim == 1:
+            _data = BlockSparseTensor(_data, self.blocks[_position], shape)
+        assert _data.shape == shape
+        if self.packed:
+            if isinstance(_data, np.ndarray):
+                _data = BlockSparseTensor.fromarray(_data, self.blocks[_position])
+        elif isinstance(_data, BlockSparseTensor):
+            _data = _data.toarray()
+        self.components[_position] = _data
+
+    def replace_component(self, _position, _component):
+        """
+        Replace the `_position`-th component by the dense ndarray `_component`, whose shape may differ from the current one.
+
+        The component has to satisfy `self.blocks[_position]` and is stored in the current storage mode.
+        """
+        assert isinstance(_component, np.ndarray) and _component.ndim == 3
+        if self.packed:
+            _component = BlockSparseTensor.fromarray(_component, self.blocks[_position])
+        self.components[_position] = _component
+
+    def truncate_edge(self, _edge, _S, _slices, _tolerance):
+        """
+        Shrink the blocks on the edge between the components `_edge` and `_edge+1`.
+
+        `_S` are the singular values of this edge, sorted in decreasing order within each of the `_slices`.
+        All singular values smaller than `_tolerance` times the largest one are dropped, but every slice retains at least
+        one index such that no slice vanishes. Only `self.blocks` is updated. The caller has to restrict the two
+        components to the returned indices.
+        """
+        threshold = _tolerance*np.max(_S)
+        keep, newSlices = [], {}
+        for slc in _slices:
+            size = max(int(np.count_nonzero(_S[slc] > threshold)), 1)
+            newSlices[slc.start, slc.stop] = slice(len(keep), len(keep)+size)
+            keep.extend(range(slc.start, slc.start+size))
+        self.blocks[_edge] = [Block((block[0], block[1], newSlices[block[2].start, block[2].stop])) for block in self.blocks[_edge]]
+        self.blocks[_edge+1] = [Block((newSlices[block[0].start, block[0].stop], block[1], block[2])) for block in self.blocks[_edge+1]]
+        return np.array(keep, dtype=int)
+
+    def modeproduct(self, _position, _matrix, _mode):
+        """
+        Contract the `_mode`-th mode of the `_position`-th component with the first mode of `_matrix`.
+        """
+        comp = self.components[_position]
+        if isinstance(comp, BlockSparseTensor):
+            self.components[_position] = comp.modeproduct(_matrix, _mode)
+        else:
+            self.components[_position] = np.moveaxis(np.tensordot(comp, _matrix, axes=(_mode, 0)), -1, _mode)
+
+    def contract_left(self, _position, _left, _measure):
+        """
+        Compute `einsum('nl,ne,ler -> nr', _left, _measure, component)` for the `_position`-th component.
+
+        The contraction is performed in the dtype of `_left` (e.g. float32 for float32 stacks).
+        """
+        comp = self.components[_position]
+        dtype = _left.dtype
+        if isinstance(comp, BlockSparseTensor):
+            ret = np.zeros((len(_left), comp.shape[2]), dtype=dtype)
+            for block, values in comp.items():
+                ret[:, block[2]] += np.einsum('nl,ne,ler -> nr', _left[:, block[0]], _measure[:, block[1]].astype(dtype, copy=False), values.astype(dtype, copy=False))
+            return ret
+        return np.einsum('nl,ne,ler -> nr', _left, _measure.astype(dtype, copy=False), comp.astype(dtype, copy=False))
+
+    def contract_right(self, _position, _right, _measure):
+        """
+        Compute `einsum('ler,ne,nr -> nl', component, _measure, _right)` for the `_position`-th component.
+
+        The contraction is performed in the dtype of `_right`.
+        """
+        comp = self.components[_position]
+        dtype = _right.dtype
+        if isinstance(comp, BlockSparseTensor):
+            ret = np.zeros((len(_right), comp.shape[0]), dtype=dtype)
+            for block, values in comp.items():
+                ret[:, block[0]] += np.einsum('ler,ne,nr -> nl', values.astype(dtype, copy=False), _measure[:, block[1]].astype(dtype, copy=False), _right[:, block[2]])
+            return ret
+        return np.einsum('ler,ne,nr -> nl', comp.astype(dtype, copy=False), _measure.astype(dtype, copy=False), _right)
+
+    def contract_measure(self, _position, _measure):
+        """
+        Compute `einsum('ne,ler -> nlr', _measure, component)` for the `_position`-th component.
+
+        For packed components only the non-zero blocks are contracted.
+        """
+        comp = self.components[_position]
+        if isinstance(comp, BlockSparseTensor):
+            ret = np.zeros((len(_measure), comp.shape[0], comp.shape[2]), dtype=np.result_type(_measure, comp.dtype))
+            for block, values in comp.items():
+                ret[:, block[0], block[2]] += np.tensordot(_measure[:, block[1]], values, axes=(1, 1))
+            return ret
+        return np.tensordot(_measure, comp, axes=(1, 1))
 
     def evaluate(self, _measures):
         assert self.order > 0 and len(_measures) == self.order
         n = len(_measures[0])
-        ret = np.ones((n,1))
+        # Contract every measure with its component first and then multiply the resulting (n,l,r) matrices sample-wise.
+        ret = np.ones((n,1,1))
         for pos in range(self.order):
-            ret = np.einsum('nl,ler,ne -> nr', ret, self.components[pos], _measures[pos])
-        assert ret.shape == (n,1)
-        return ret[:,0]
+            ret = np.matmul(ret, self.contract_measure(pos, _measures[pos]))
+        assert ret.shape == (n,1,1)
+        return ret[:,0,0]
+
+    def gradient(self, _measures, _gradMeasures):
+        """
+        Compute the partial derivatives of the tensor train in a single forward-backward sweep.
+
+        `_measures` are the measures of shape (order, n, dim) as for `evaluate` and `_gradMeasures[k]` contains the
+        derivatives of the basis functions of the k-th variable for the first `len(_gradMeasures)` positions.
+        Returns an array of shape (n, len(_gradMeasures)) whose k-th column is the derivative with respect to the k-th variable.
+        """
+        assert self.order > 0 and len(_measures) == self.order and len(_gradMeasures) <= self.order
+        n, m = len(_measures[0]), len(_gradMeasures)
+        lefts = [np.ones((n, 1))]
+        for pos in range(m-1):
+            lefts.append(np.einsum('nl,nlr -> nr', lefts[-1], self.contract_measure(pos, _measures[pos])))
+        ret = np.empty((n, m))
+        right = np.ones((n, 1))
+        for pos in reversed(range(self.order)):
+            if pos < m:
+                ret[:, pos] = np.einsum('nl,nlr,nr -> n', lefts[pos], self.contract_measure(pos, _gradMeasures[pos]), right)
+            if pos > 0:
+                right = np.einsum('nlr,nr -> nl', self.contract_measure(pos, _measures[pos]), right)
+        return ret
+
+    def evaluate_stream(self, _measures):
+        """
+        Evaluate the tensor train chunk by chunk.
+
+        `_measures` is an iterable of measure arrays of shape (order, n, dim) (e.g. `misc.measure_chunks`).
+        The values of each chunk are yielded as soon as they are computed, so the measures of all samples never have to be stored at once.
+        """
+        for measures in _measures:
+            yield self.evaluate(measures)
 
     @property
     def corePosition(self):
@@ -264,14 +527,15 @@ class BlockSparseTT(object):
         return len(self.components)
     
     def increase_block(self,_deg,_u,_v,_direction):
+        packed = self.packed
         if _direction == 'left':
             slices = self.getUniqueSlices(0)
             slc = slices[_deg]
             assert self.corePosition > 0
             assert self.MaxSize(_deg,self.corePosition-1) > slc.stop - slc.start 
             
-            self.components[self.corePosition-1] = np.insert(self.components[self.corePosition-1],slc.stop,_u,axis=2)
-            self.components[self.corePosition] = np.insert(self.components[self.corePosition],slc.stop,_v,axis=0)
+            self.components[self.corePosition-1] = np.insert(self.dense_component(self.corePosition-1),slc.stop,_u,axis=2)
+            self.components[self.corePosition] = np.insert(self.dense_component(self.corePosition),slc.stop,_v,axis=0)
             
             for i  in range(len(self.blocks[self.corePosition])):
                 block = self.blocks[self.corePosition][i]
@@ -290,10 +554,10 @@ class BlockSparseTT(object):
             slices = self.getUniqueSlices(2)
             slc = slices[_deg]
             assert self.corePosition < self.order-1
-            assert self.MaxSize(_deg,self.corePosition-1) > slc.stop - slc.start 
+            assert self.MaxSize(_deg,self.corePosition) > slc.stop - slc.start 
             
-            self.components[self.corePosition] = np.insert(self.components[self.corePosition],slc.stop,_u,axis=2)
-            self.components[self.corePosition+1] = np.insert(self.components[self.corePosition+1],slc.stop,_v,axis=0)
+            self.components[self.corePosition] = np.insert(self.dense_component(self.corePosition),slc.stop,_u,axis=2)
+            self.components[self.corePosition+1] = np.insert(self.dense_component(self.corePosition+1),slc.stop,_v,axis=0)
             
             for i  in range(len(self.blocks[self.corePosition])):
                 block = self.blocks[self.corePosition][i]
@@ -307,8 +571,13 @@ class BlockSparseTT(object):
                     self.blocks[self.corePosition+1][i] = Block((slice(block[0].start,block[0].stop+1),block[1],block[2]))
                 if block[0].start > slc.start:
                     self.blocks[self.corePosition+1][i] = Block((slice(block[0].start+1,block[0].stop+1),block[1],block[2]))
-       
-        self.verify()
+
+        if packed:
+            self.components = [BlockSparseTensor.fromarray(comp, blks) if isinstance(comp, np.ndarray) else comp for comp, blks in zip(self.components, self.blocks)]
+        if _direction == 'left':
+            self.verify_update([self.corePosition-1, self.corePosition])
+        else:
+            self.verify_update([self.corePosition, self.corePosition+1])
     
     
     
@@ -339,43 +608,62 @@ class BlockSparseTT(object):
         mr, mk = self.dimensions[0]-1-r, self.order-k
         return min(comb(k+r-1,k-1), comb(mk+mr-1, mk-1), _maxGroupSize)
 
-    def move_core(self, _direction):
+    def move_core(self, _direction, _tolerance=0):
+        """
+        Move the core one position to the `_direction` and return the singular values of the edge that was crossed.
+
+        If `_tolerance > 0` all singular values that are smaller than `_tolerance` times the largest one are discarded
+        together with the corresponding slices of the two components on this edge (see `truncate_edge`).
+        """
         assert isinstance(self.corePosition, int)
         assert _direction in ['left', 'right']
+        assert _tolerance >= 0
         S = None
         if _direction == 'left':
             assert 0 < self.corePosition
 
-            CORE = BlockSparseTensor.fromarray(self.components[self.corePosition], self.blocks[self.corePosition])
+            CORE = self.packed_component(self.corePosition)
             U, S, Vt = CORE.svd(0)
 
-            nextCore = self.components[self.corePosition-1]
-            self.components[self.corePosition-1] = (nextCore.reshape(-1, nextCore.shape[2]) @ U @ S).reshape(nextCore.shape)
-            self.components[self.corePosition] = Vt
+            if _tolerance > 0:
+                US = U.toarray() * S
+                keep = self.truncate_edge(self.corePosition-1, S, [slc for slc, _ in CORE.plan.mode_groups(0)], _tolerance)
+                self.replace_component(self.corePosition-1, np.tensordot(self.dense_component(self.corePosition-1), US[:, keep], axes=(2, 0)))
+                self.replace_component(self.corePosition, Vt.toarray()[keep])
+                S = S[keep]
+            else:
+                self.modeproduct(self.corePosition-1, U.toarray() * S, 2)
+                self.set_component(self.corePosition, Vt)
 
             self.__corePosition -= 1
         else:
             assert self.corePosition < self.order-1
 
-            CORE = BlockSparseTensor.fromarray(self.components[self.corePosition], self.blocks[self.corePosition])
+            CORE = self.packed_component(self.corePosition)
             U, S, Vt = CORE.svd(2)
 
-            nextCore = self.components[self.corePosition+1]
-            self.components[self.corePosition] = Vt
-            self.components[self.corePosition+1] = (S @ U.T @ nextCore.reshape(nextCore.shape[0], -1)).reshape(nextCore.shape)
+            if _tolerance > 0:
+                US = U.toarray() * S
+                keep = self.truncate_edge(self.corePosition, S, [slc for slc, _ in CORE.plan.mode_groups(2)], _tolerance)
+                self.replace_component(self.corePosition, Vt.toarray()[:, :, keep])
+                self.replace_component(self.corePosition+1, np.tensordot(US[:, keep], self.dense_component(self.corePosition+1), axes=(0, 0)))
+                S = S[keep]
+            else:
+                self.set_component(self.corePosition, Vt)
+                self.modeproduct(self.corePosition+1, U.toarray() * S, 0)  # (U @ S).T == S @ U.T
 
             self.__corePosition += 1
-        self.verify()
-        return S.diagonal()
+        self.verify_update([self.corePosition, self.corePosition+1] if _direction == 'left' else [self.corePosition-1, self.corePosition])
+        return S
 
     def dofs(self):
-        return sum(BlockSparseTensor.fromarray(comp, blks).dofs() for comp, blks in zip(self.components, self.blocks))
+        return sum(Block(blk).size for blks in self.blocks for blk in blks)
 
     @classmethod
-    def random(cls, _dimensions, _ranks, _blocks):
+    def random(cls, _dimensions, _ranks, _blocks, _dtype=np.float64):
         assert len(_ranks)+1 == len(_dimensions)
         ranks = [1] + _ranks + [1]
-        components = [np.zeros((leftRank, dimension, rightRank)) for leftRank, dimension, rightRank in zip(ranks[:-1], _dimensions, ranks[1:])]
+        components = [np.zeros((leftRank, dimension, rightRank), dtype=_dtype) for leftRank, dimension, rightRank in zip(ranks[:-1], _dimensions, ranks[1:])]
         for comp, compBlocks in zip(components, _blocks):
             for block in compBlocks:
                 comp[block] = np.random.randn(*comp[block].shape)
@@ -384,6 +672,8 @@ class BlockSparseTT(object):
     
     
 class BlockSparseTTSystem(object):
+    verifyLevel = 'paranoid'  # see BlockSparseTT.verifyLevel
+
     def __init__(self, _components, _blocks,_selectionMatrix,_numberOfEquations=None):
         """
         _components : list of ndarrays of order 3
@@ -421,13 +711,25 @@ class BlockSparseTTSystem(object):
         self.__corePosition = None
         self.verify()
 
-    def verify(self):
-        for e, (compBlocks, component) in enumerate(zip(self.blocks, self.components)):
+    def verify(self, _positions=None):
+        """
+        Check that the components at `_positions` (default: all components) satisfy the block structure.
+        """
+        if _positions is None:
+            _positions = range(self.order)
+        for e in _positions:
+            compBlocks, component = self.blocks[e], self.components[e]
             assert np.all(np.isfinite(component))
-            cmp = np.array(component)
-            for block in compBlocks:
-                cmp[block] = 0
-            assert np.allclose(cmp, 0), f"Component {e} does not satisfy the block structure. Error: {np.max(abs(cmp)):.2e}"
+            res = BlockPlan.get([Block(block) for block in compBlocks], component.shape).residue(component)
+            assert np.allclose(res, 0), f"Component {e} does not satisfy the block structure. Error: {np.max(abs(res), initial=0):.2e}"
+
+    def verify_update(self, _positions):
+        """
+        Check the modified components at `_positions` if `verifyLevel == 'paranoid'`.
+        """
+        assert self.verifyLevel in ['off', 'sweep', 'paranoid']
+        if self.verifyLevel == 'paranoid':
+            self.verify(_positions)
 
     def evaluate(self, _measures):
         assert self.order > 0 and len(_measures) == self.order
@@ -438,6 +740,13 @@ class BlockSparseTTSystem(object):
         assert ret.shape == (n,1,self.numberOfEquations)
         return ret[:,0,:]
 
+    def evaluate_stream(self, _measures):
+        """
+        Evaluate the system chunk by chunk (see `BlockSparseTT.evaluate_stream`).
+        """
+        for measures in _measures:
+            yield self.evaluate(measures)
+
 
     @property
     def corePosition(self):
@@ -490,7 +799,7 @@ class BlockSparseTTSystem(object):
             slices = self.getUniqueSlices(3)
             slc = slices[_deg]
             assert self.corePosition < self.order-1
-            assert self.MaxSize(_deg,self.corePosition-1) > slc.stop - slc.start 
+            assert self.MaxSize(_deg,self.corePosition) > slc.stop - slc.start 
             
             self.components[self.corePosition] = np.insert(self.components[self.corePosition],slc.stop,_u,axis=3)
             self.components[self.corePosition+1] = np.insert(self.components[self.corePosition+1],slc.stop,_v,axis=0)
@@ -508,7 +817,10 @@ class BlockSparseTTSystem(object):
                 if block[0].start > slc.start:
                     self.blocks[self.corePosition+1][i] = Block((slice(block[0].start+1,block[0].stop+1),block[1],block[2],block[3]))
 
-        self.verify()
+        if _direction == 'left':
+            self.verify_update([self.corePosition-1, self.corePosition])
+        else:
+            self.verify_update([self.corePosition, self.corePosition+1])
     
     
     
@@ -550,8 +862,8 @@ class BlockSparseTTSystem(object):
             U, S, Vt = CORE.svd(0)
 
             nextCore = self.components[self.corePosition-1]
-            self.components[self.corePosition-1] = 1/scale*(nextCore.reshape(-1, nextCore.shape[3]) @ U @ S).reshape(nextCore.shape)
-            self.components[self.corePosition] = scale*Vt
+            self.components[self.corePosition-1] = 1/scale*(nextCore.reshape(-1, nextCore.shape[3]) @ (U.toarray() * S)).reshape(nextCore.shape)
+            self.components[self.corePosition] = scale*Vt.toarray()
 
             self.__corePosition -= 1
         else:
@@ -561,12 +873,12 @@ class BlockSparseTTSystem(object):
             U, S, Vt = CORE.svd(3)
 
             nextCore = self.components[self.corePosition+1]
-            self.components[self.corePosition] = scale*Vt
-            self.components[self.corePosition+1] = 1/scale*(S @ U.T @ nextCore.reshape(nextCore.shape[0], -1)).reshape(nextCore.shape)
+            self.components[self.corePosition] = scale*Vt.toarray()
+            self.components[self.corePosition+1] = 1/scale*((U.toarray() * S).T @ nextCore.reshape(nextCore.shape[0], -1)).reshape(nextCore.shape)
 
             self.__corePosition += 1
-        self.verify()
-        return S.diagonal()
+        self.verify_update([self.corePosition, self.corePosition+1] if _direction == 'left' else [self.corePosition-1, self.corePosition])
+        return S
 
     def dofs(self):
         return sum(BlockSparseTensor.fromarray(comp, blks).dofs() for comp, blks in zip(self.components, self.blocks))
@@ -589,6 +901,8 @@ class BlockSparseTTSystem(object):
         return cls(components, _blocks,_selectionMatrix,_numberOfEquations)
 
 class BlockSparseTTSystem2(object):
+    verifyLevel = 'paranoid'  # see BlockSparseTT.verifyLevel
+
     def __init__(self, _bstts,_selectionMatrix,_numberOfEquations=None):
         """
         """
@@ -616,27 +930,90 @@ class BlockSparseTTSystem2(object):
         self.selectionMatrix = _selectionMatrix.astype(int)
         self.verify()
 
-    def verify(self):
+    def verify(self, _positions=None):
+        for bstt in self.bstts:
+            bstt.verify(_positions)
+
+    def verify_update(self, _positions):
+        """
+        Check the modified components at `_positions` of all BlockSparseTTs if `verifyLevel == 'paranoid'`.
+        """
+        assert self.verifyLevel in ['off', 'sweep', 'paranoid']
+        if self.verifyLevel == 'paranoid':
+            self.verify(_positions)
+
+    @property
+    def packed(self):
+        return self.bstts[0].packed
+
+    def pack(self):
+        for bstt in self.bstts:
+            bstt.pack()
+
+    def unpack(self):
         for bstt in self.bstts:
-            for e, (compBlocks, component) in enumerate(zip(bstt.blocks, bstt.components)):
-                assert np.all(np.isfinite(component))
-                cmp = np.array(component)
-                for block in compBlocks:
-                    cmp[block] = 0
-                assert np.allclose(cmp, 0), f"Component {e} does not satisfy the block structure. Error: {np.max(abs(cmp)):.2e}"
+            bstt.unpack()
 
     def evaluate(self, _measures):
         assert self.order > 0 and len(_measures) == self.order
         m = len(_measures[0])
-        ret = [np.ones([m,1])]*self.numberOfEquations
+        # The contraction of a measure with a component only depends on the position and the selected BlockSparseTT.
+        # It is computed once and shared by all equations that select the same BlockSparseTT at this position.
+        contractions = {}
+        def contraction(sel, pos):
+            if (sel, pos) not in contractions:
+                contractions[sel, pos] = self.bstts[sel].contract_measure(pos, _measures[pos])
+            return contractions[sel, pos]
+
+        # Equations that select the same BlockSparseTTs at the first (last) positions share the partial left (right)
+        # products. For every equation we determine the longest prefix (suffix) of its row of the selection matrix that
+        # it shares with any other equation. These partial products are computed only once by extending the longest
+        # partial product that was already computed. Only the positions in between are contracted for each equation.
+        selectionMatrix = self.selectionMatrix[:self.numberOfEquations]
+        equal = selectionMatrix[:,None,:] == selectionMatrix[None,:,:]
+        common = np.cumprod(equal, axis=2).sum(axis=2)
+        np.fill_diagonal(common, 0)
+        prefixLengths = common.max(axis=1)
+        common = np.cumprod(equal[:,:,::-1], axis=2).sum(axis=2)
+        np.fill_diagonal(common, 0)
+        suffixStarts = np.maximum(self.order - common.max(axis=1), prefixLengths)
+
+        prefixes = {(): np.ones([m,1,1])}
+        for eq in np.argsort(prefixLengths, kind='stable'):
+            row, a = tuple(selectionMatrix[eq].tolist()), prefixLengths[eq]
+            p = max(p for p in range(a+1) if row[:p] in prefixes)
+            prefix = prefixes[row[:p]]
+            for pos in range(p, a):
+                prefix = np.matmul(prefix, contraction(row[pos], pos))
+            prefixes[row[:a]] = prefix
+
+        suffixes = {(): np.ones([m,1,1])}
+        for eq in np.argsort(-suffixStarts, kind='stable'):
+            row, b = tuple(selectionMatrix[eq].tolist()), suffixStarts[eq]
+            q = min(q for q in range(b, self.order+1) if row[q:] in suffixes)
+            suffix = suffixes[row[q:]]
+            for pos in reversed(range(b, q)):
+                suffix = np.matmul(contraction(row[pos], pos), suffix)
+            suffixes[row[b:]] = suffix
+
+        ret = []
         for eq in range(self.numberOfEquations):
-            for pos in range(self.order):
-                comp = self.bstts[self.selectionMatrix[eq,pos]].components[pos]
-                ret[eq] = np.einsum('ml,ler,me -> mr', ret[eq], comp, _measures[pos])
-        ret = np.concatenate(ret,axis=1)
+            row, a, b = tuple(selectionMatrix[eq].tolist()), prefixLengths[eq], suffixStarts[eq]
+            res = prefixes[row[:a]]
+            for pos in range(a, b):
+                res = np.matmul(res, contraction(row[pos], pos))
+            ret.append(np.matmul(res, suffixes[row[b:]]))
+        ret = np.concatenate(ret,axis=2)[:,0]
         assert ret.shape == (m,self.numberOfEquations)
         return ret[:,:]
 
+    def evaluate_stream(self, _measures):
+        """
+        Evaluate the system chunk by chunk (see `BlockSparseTT.evaluate_stream`).
+        """
+        for measures in _measures:
+            yield self.evaluate(measures)
+
 
     @property
     def corePosition(self):
@@ -675,11 +1052,10 @@ class BlockSparseTTSystem2(object):
             assert 0 < self.corePosition
             for bstt in self.bstts:
                 #bstt.move_core('left')
-                CORE = BlockSparseTensor.fromarray(bstt.components[bstt.corePosition], bstt.blocks[bstt.corePosition])
+                CORE = bstt.packed_component(bstt.corePosition)
                 U, S, Vt = CORE.svd(0)
-                bstt.components[bstt.corePosition] = Vt
-                nextCore = bstt.components[bstt.corePosition-1]
-                bstt.components[bstt.corePosition-1] = (nextCore.reshape(-1, nextCore.shape[2]) @ U ).reshape(nextCore.shape)
+                bstt.set_component(bstt.corePosition, Vt)
+                bstt.modeproduct(bstt.corePosition-1, U.toarray(), 2)
                 bstt.assume_corePosition(bstt.corePosition - 1)
 
             self.__corePosition -= 1
@@ -689,25 +1065,24 @@ class BlockSparseTTSystem2(object):
 
             for bstt in self.bstts:
                 #bstt.move_core('right')
-                CORE = BlockSparseTensor.fromarray(bstt.components[bstt.corePosition], bstt.blocks[bstt.corePosition])
-                U, S, Vt = CORE.svd(2)                
-                bstt.components[bstt.corePosition] = Vt
-                nextCore = bstt.components[bstt.corePosition+1]
-                bstt.components[bstt.corePosition+1] = (U.T @ nextCore.reshape(nextCore.shape[0], -1)).reshape(nextCore.shape)
+                CORE = bstt.packed_component(bstt.corePosition)
+                U, S, Vt = CORE.svd(2)
+                bstt.set_component(bstt.corePosition, Vt)
+                bstt.modeproduct(bstt.corePosition+1, U.toarray(), 0)  # U.T @ nextCore
                 bstt.assume_corePosition(bstt.corePosition + 1)
 
             self.__corePosition += 1
-        self.verify()
+        self.verify_update([self.corePosition, self.corePosition+1] if _direction == 'left' else [self.corePosition-1, self.corePosition])
 
     def dofs(self):
         return sum([bstt.dofs() for bstt in self.bstts])
 
     @classmethod
     def random(cls, _dimensions, _ranks, _blocks,_numberOfEquations,
-               _numberOfInteractions,_selectionMatrix):
+               _numberOfInteractions,_selectionMatrix,_dtype=np.float64):
         assert len(_ranks)+1 == len(_dimensions)
         bstts = []
         for i in range(_numberOfInteractions):
-            bstts.append(BlockSparseTT.random(_dimensions, _ranks, _blocks))        
+            bstts.append(BlockSparseTT.random(_dimensions, _ranks, _blocks, _dtype))        
         return cls(bstts,_selectionMatrix,_numberOfEquations)
     
@@ -27,16 +27,10 @@ def fermi_pasta_ulam(number_of_oscillators, number_of_snapshots):
     # define random snapshot matrix
     snapshots = 2 * np.random.rand(number_of_oscillators, number_of_snapshots) - 1
 
-    # compute derivatives
-    derivatives = np.zeros((number_of_oscillators, number_of_snapshots))
-    for j in range(number_of_snapshots):
-        derivatives[0, j] = snapshots[1, j] - 2 * snapshots[0, j] + 0.7 * (
-                (snapshots[1, j] - snapshots[0, j]) ** 3 - snapshots[0, j] ** 3)
-        for i in range(1, number_of_oscillators - 1):
-            derivatives[i, j] = snapshots[i + 1, j] - 2 * snapshots[i, j] + snapshots[i - 1, j] + 0.7 * (
-                    (snapshots[i + 1, j] - snapshots[i, j]) ** 3 - (snapshots[i, j] - snapshots[i - 1, j]) ** 3)
-        derivatives[-1, j] = - 2 * snapshots[-1, j] + snapshots[-2, j] + 0.7 * (
-                -snapshots[-1, j] ** 3 - (snapshots[-1, j] - snapshots[-2, j]) ** 3)
+    # compute derivatives (for all snapshots at once, the displacements at both ends are fixed to zero)
+    padded = np.pad(snapshots, ((1, 1), (0, 0)))
+    derivatives = padded[2:] - 2 * padded[1:-1] + padded[:-2] + 0.7 * (
+            (padded[2:] - padded[1:-1]) ** 3 - (padded[1:-1] - padded[:-2]) ** 3)
 
     return snapshots.T, derivatives.T
 
@@ -69,16 +63,17 @@ def fermi_pasta_ulam2(number_of_oscillators, number_of_snapshots, kappa, beta):
     # define random snapshot matrix
     snapshots = 2 * np.random.rand(number_of_oscillators, number_of_snapshots) - 1
 
-    # compute derivatives
-    derivatives = np.zeros((number_of_oscillators, number_of_snapshots))
-    for j in range(number_of_snapshots):
-        derivatives[0, j] = kappa[1] * (snapshots[1, j] - snapshots[0, j]) - kappa[0] * snapshots[0, j] + beta[1] * (
-            snapshots[1, j] - snapshots[0, j]) ** 3 - beta[0] * snapshots[0, j] ** 3
-        for i in range(1, number_of_oscillators - 1):
-            derivatives[i, j] = kappa[i+1] * (snapshots[i + 1, j] - snapshots[i, j]) - kappa[i] * (snapshots[i, j] - snapshots[i - 1, j]) + beta[i+1] * (
-                    snapshots[i + 1, j] - snapshots[i, j]) ** 3 - beta[i] * (snapshots[i, j] - snapshots[i - 1, j]) ** 3
-        derivatives[-1, j] = - kappa[-1] * snapshots[-1, j] - kappa[-2] * (snapshots[-1, j] - snapshots[-2, j]) + beta[-1] * (
-                -snapshots[-1, j]) ** 3 - beta[-2] * (snapshots[-1, j] - snapshots[-2, j]) ** 3
+    # compute derivatives (for all snapshots at once, the displacements at both ends are fixed to zero)
+    # The coefficients of the springs to the right (left) of each oscillator. The last oscillator uses kappa[-1] (kappa[-2]).
+    kappa, beta = np.asarray(kappa), np.asarray(beta)
+    kappa_right = np.append(kappa[1:number_of_oscillators], kappa[-1])[:, None]
+    kappa_left = np.append(kappa[:number_of_oscillators-1], kappa[-2])[:, None]
+    beta_right = np.append(beta[1:number_of_oscillators], beta[-1])[:, None]
+    beta_left = np.append(beta[:number_of_oscillators-1], beta[-2])[:, None]
+    padded = np.pad(snapshots, ((1, 1), (0, 0)))
+    right = padded[2:] - padded[1:-1]
+    left = padded[1:-1] - padded[:-2]
+    derivatives = kappa_right * right - kappa_left * left + beta_right * right ** 3 - beta_left * left ** 3
 
     return snapshots.T, derivatives.T
 
@@ -87,14 +82,13 @@ def massive_particles(number_of_equations, number_of_samples,G,m,r):
     # define random snapshot matrix
     x = r*(2 * np.random.rand(number_of_equations, number_of_samples) - 1)
 
-    # compute derivatives
+    # compute derivatives (for all samples and particles at once)
+    m = np.asarray(m)
     xdot = np.zeros((number_of_equations, number_of_samples))
-    for j in range(number_of_samples):
-        for i in range(number_of_equations):
-            for k in range(number_of_equations):
-                if k!=i:
-                    diff = x[i,j]-x[k,j]
-                    xdot[i, j] -= G*m[i]*m[k]/(np.abs(diff)**3)*diff
+    for k in range(number_of_equations):
+        others = np.arange(number_of_equations) != k
+        diff = x[others]-x[k]
+        xdot[others] -= G*m[others,None]*m[k]/(np.abs(diff)**3)*diff
 
     return x, xdot
 
@@ -111,58 +105,53 @@ def lennardJonesParam(t,x,sigma,exp):
     assert 2*n == len(x)
     y = x[:n]
     v = x[n:]
-    res = np.zeros([n])
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                res[i] += np.sign(y[i]-y[j])*6/sigma[i,j]*((sigma[i,j]/np.abs(y[i]-y[j]))**(2*exp+1) -(sigma[i,j]/np.abs(y[i]-y[j]))**(exp+1)  )
+    res = lennardJonesParam2(y,sigma,exp)
     v = v.reshape(-1)
     return np.concatenate([v,res])
 
+# The following functions accept the positions of a single sample (shape (n,)) or of many samples (shape (n, N)).
+# The interactions are accumulated over the partner particle j for all particles and samples at once.
+
 def lennardJonesParam2(x,sigma,exp):
     n = len(x)
-    res = np.zeros([n])
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                res[i] += np.sign(x[i]-x[j])*6/sigma[i,j]*((sigma[i,j]/np.abs(x[i]-x[j]))**(2*exp+1) -(sigma[i,j]/np.abs(x[i]-x[j]))**(exp+1)  )
-    return res
+    X = x.reshape(n,-1)
+    res = np.zeros(X.shape)
+    for j in range(n):
+        others = np.arange(n) != j
+        diff = X[others]-X[j]
+        sig = sigma[others,j][:,None]
+        res[others] += np.sign(diff)*6/sig*((sig/np.abs(diff))**(2*exp+1) -(sig/np.abs(diff))**(exp+1)  )
+    return res.reshape(x.shape)
 
 def lennardJonesParam2Mod(x,exp):
     n = len(x)
-    res = np.zeros([n])
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                #res[i] +=((1/(x[i]-x[j]))**(2*exp+1) -(1/(x[i]-x[j]))**(exp+1)  )
-                res[i] += np.sign(x[i]-x[j])*((1/np.abs(x[i]-x[j]))**(2*exp+1) -(1/np.abs(x[i]-x[j]))**(exp+1)  )
-        if i > 0: 
-            res[i]*= (x[i]-x[i-1])**(2*exp+1)
-        #if i > 1: 
-        #    res[i]*= (x[i]-x[i-2])**(2*exp+1)
-        if i < n-1:
-            res[i]*= (x[i]-x[i+1])**(2*exp+1)
-        #if i < n-2:
-        #    res[i]*= (x[i]-x[i+2])**(2*exp+1)
-    return res
+    X = x.reshape(n,-1)
+    res = np.zeros(X.shape)
+    for j in range(n):
+        others = np.arange(n) != j
+        diff = X[others]-X[j]
+        #res[others] +=((1/diff)**(2*exp+1) -(1/diff)**(exp+1)  )
+        res[others] += np.sign(diff)*((1/np.abs(diff))**(2*exp+1) -(1/np.abs(diff))**(exp+1)  )
+    res[1:]*= (X[1:]-X[:-1])**(2*exp+1)
+    #res[2:]*= (X[2:]-X[:-2])**(2*exp+1)
+    res[:-1]*= (X[:-1]-X[1:])**(2*exp+1)
+    #res[:-2]*= (X[:-2]-X[2:])**(2*exp+1)
+    return res.reshape(x.shape)
 
 
 def lennardJonesParam3Mod(x,exp):
     n = len(x)
-    res = np.zeros([n])
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                res[i] +=((1/(x[i]-x[j]))**(2*exp+1) -(1/(x[i]-x[j]))**(exp+1)  )
-        if i > 0: 
-            res[i]*= (x[i]-x[i-1])**(2*exp+1)
-        #if i > 1: 
-        #    res[i]*= (x[i]-x[i-2])**(2*exp+1)
-        if i < n-1:
-            res[i]*= (x[i]-x[i+1])**(2*exp+1)
-        #if i < n-2:
-        #    res[i]*= (x[i]-x[i+2])**(2*exp+1)
-    return res
+    X = x.reshape(n,-1)
+    res = np.zeros(X.shape)
+    for j in range(n):
+        others = np.arange(n) != j
+        diff = X[others]-X[j]
+        res[others] +=((1/diff)**(2*exp+1) -(1/diff)**(exp+1)  )
+    res[1:]*= (X[1:]-X[:-1])**(2*exp+1)
+    #res[2:]*= (X[2:]-X[:-2])**(2*exp+1)
+    res[:-1]*= (X[:-1]-X[1:])**(2*exp+1)
+    #res[:-2]*= (X[:-2]-X[2:])**(2*exp+1)
+    return res.reshape(x.shape)
 
 
 def randNum(a,b):
@@ -170,53 +159,43 @@ def randNum(a,b):
 
 
 def lennardJonesSamplesMod(order,number_of_samples,c,exp,mod=0):
-    samples = []
-    count = 0
     a=1.0
     b=2.0
-    while(count < number_of_samples):        
-        sample = c*order/2*np.random.rand(1) - c*order
-        for i in range(0,order-1):
-            nextSample = sample[-1]+a+np.random.rand(1)*(b-a)
-            sample = np.append(sample,nextSample)
-        samples.append(sample)
-        count+=1
-    samples = np.column_stack(samples)
+    # Each row holds the random numbers of one sample: the position of the first particle followed by the spacings.
+    rnd = np.random.rand(number_of_samples, order)
+    samples = np.cumsum(np.column_stack([c*order/2*rnd[:,0] - c*order, a+rnd[:,1:]*(b-a)]), axis=1).T
     #samples =  (2 * np.random.rand(order,number_of_samples) - 1)
-    derivatives = []
-    for k in range(number_of_samples):
-        if mod == 0:
-            derivatives.append(lennardJonesParam2Mod(samples[:,k],exp))
-        else:
-            derivatives.append(lennardJonesParam3Mod(samples[:,k],exp))
-    derivatives = np.column_stack(derivatives)
+    if mod == 0:
+        derivatives = lennardJonesParam2Mod(samples,exp)
+    else:
+        derivatives = lennardJonesParam3Mod(samples,exp)
     
     assert samples.shape == derivatives.shape
     return samples.T,derivatives.T
 
 def lennardJonesSamples(order,number_of_samples,c,sigma,exp):
-    samples = []
-    count = 0
     a=1.05
     b=1.95
-    while(count < number_of_samples):        
-        sample = c*order*(2 * np.random.rand(1) - 1)
-        for i in range(0,order-1):
-            nextSample = sample[-1]+a+np.random.rand(1)*(b-a)
-            sample = np.append(sample,nextSample)
-        samples.append(sample)
-        count+=1
-
-    samples = np.column_stack(samples)
-    derivatives = []
-    for k in range(number_of_samples):
-        derivatives.append(lennardJonesParam2(samples[:,k],sigma,exp))
-    derivatives = np.column_stack(derivatives)
+    # Each row holds the random numbers of one sample: the position of the first particle followed by the spacings.
+    rnd = np.random.rand(number_of_samples, order)
+    samples = np.cumsum(np.column_stack([c*order*(2 * rnd[:,0] - 1), a+rnd[:,1:]*(b-a)]), axis=1).T
+
+    derivatives = lennardJonesParam2(samples,sigma,exp)
     
     assert samples.shape == derivatives.shape
     return samples.T,derivatives.T
 
 
+def samplesInChunks(sampler,order,number_of_samples,chunk_size,*args):
+    """Generate the samples of `sampler` (e.g. lennardJonesSamplesMod) in chunks.
+    Yields the pairs (samples, derivatives) returned by `sampler(order, n, *args)` for chunks of n <= chunk_size samples.
+    For lennardJonesSamples and lennardJonesSamplesMod the concatenated chunks equal the samples drawn at once.
+    """
+    assert chunk_size > 0
+    for start in range(0,number_of_samples,chunk_size):
+        yield sampler(order,min(chunk_size,number_of_samples-start),*args)
+
+
 def lennardjonesenergy(x,sigma,exp):
     n = len(x)// 2
     assert 2*n == len(x)
@@ -234,29 +213,23 @@ def magneticDipolesParam(t,y,M,x,I):
     assert 2*n == len(y)
     phi = y[:n]
     J = y[n:]
-    res = np.zeros([n])
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                res[i] += M[i]*M[j]/(np.abs(x[i]-x[j])**3)*np.sin(phi[j]-phi[i])
+    res = magneticDipolesParam2(phi,M,x,I)
     J = J.reshape(-1)
     return np.concatenate([J/I,res])
 
 def magneticDipolesParam2(phi,M,x,I):
     n = len(phi)
-    res = np.zeros([n])
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                res[i] += M[i]*M[j]/(np.abs(x[i]-x[j])**3)*np.sin(phi[j]-phi[i])
-    return res
+    M, x = np.asarray(M), np.asarray(x)
+    Phi = phi.reshape(n,-1)
+    res = np.zeros(Phi.shape)
+    for j in range(n):
+        others = np.arange(n) != j
+        res[others] += (M[others]*M[j]/(np.abs(x[others]-x[j])**3))[:,None]*np.sin(Phi[j]-Phi[others])
+    return res.reshape(phi.shape)
 
 def magneticDipolesSamples(order,number_of_samples,M,x,I):
     samples = np.pi*(2 * np.random.rand(order, number_of_samples) - 1)
-    derivatives = []
-    for k in range(number_of_samples):
-        derivatives.append(magneticDipolesParam2(samples[:,k],M,x,I))
-    derivatives = np.column_stack(derivatives)
+    derivatives = magneticDipolesParam2(samples,M,x,I)
     
     assert samples.shape == derivatives.shape
     return samples.T,derivatives.T
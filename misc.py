@@ -505,6 +505,13 @@ def legendre_measures_grad2(_points, _degree,_a=-1,_b=1):
     ret_der = legval(2/(_b-_a)*(_points-_a)-1, 2/(_b-_a)*legder(np.diag(factors))).T
     return ret,ret_der
 
+def legendre_gradient_measures(_points, _degree,_a=-1,_b=1,_augment=False):
+    """
+    Lazy version of `legendre_measures_grad`: `legendre_gradient_measures(...)[k]` behaves like `legendre_measures_grad(...)[k]`
+    but only the measures and their derivatives are stored (see `GradientMeasures`).
+    """
+    return GradientMeasures(*legendre_measures_grad2(_points, _degree, _a, _b), _augment=_augment)
+
 def hermite_measures(_points, _degree):
     N,M = _points.shape
     factors = 1/np.sqrt(np.sqrt(2*np.pi)*np.array([factorial(l) for l in range(_degree+1)]))
@@ -512,6 +519,141 @@ def hermite_measures(_points, _degree):
     assert ret.shape == (M, N, _degree+1)
     return ret
 
+class LazySequence(object):
+    """
+    Base class of the lazy measure sequences below.
+
+    Subclasses define `__len__` and `_get(_position)`, which computes the entry at a non-negative `_position`.
+    Indexing (with negative positions), iteration and `toarray` are provided here.
+    """
+    def _get(self, _position):
+        raise NotImplementedError
+
+    def __getitem__(self, _position):
+        assert isinstance(_position, (int, np.integer))
+        if _position < 0:
+            _position += len(self)
+        assert 0 <= _position < len(self)
+        return self._get(_position)
+
+    def __iter__(self):
+        for pos in range(len(self)):
+            yield self[pos]
+
+    def toarray(self):
+        return np.stack([entry.toarray() if isinstance(entry, LazySequence) else entry for entry in self])
+
+class Measures(LazySequence):
+    """
+    Lazy measures of `_points` with respect to a measure function.
+
+    Behaves like the array `_measures(_points, *_args)` of shape (order, N, dim) but computes the measures of a single
+    position only when it is accessed. With `_augment=True` a constant position of ones is appended (as for the augmented
+    measures in the experiments) without storing it. With `_cache=True` the computed positions are kept in memory.
+    """
+    def __init__(self, _points, _measures, *_args, _augment=False, _cache=False):
+        assert isinstance(_points, np.ndarray) and _points.ndim == 2
+        assert callable(_measures)
+        self.points = _points
+        self.measures = _measures
+        self.args = _args
+        self.augment = _augment
+        self.cache = {} if _cache else None
+        self.dimension = self.measure(0).shape[1]
+
+    def measure(self, _position):
+        if self.cache is not None and _position in self.cache:
+            return self.cache[_position]
+        ret = self.measures(self.points[:, _position:_position+1], *self.args)[0]
+        if self.cache is not None:
+            self.cache[_position] = ret
+        return ret
+
+    def _get(self, _position):
+        if _position == self.points.shape[1]:
+            return np.broadcast_to(np.ones(self.dimension), (self.points.shape[0], self.dimension))
+        return self.measure(_position)
+
+    def __len__(self):
+        return self.points.shape[1] + int(self.augment)
+
+    @property
+    def shape(self):
+        return (len(self), self.points.shape[0], self.dimension)
+
+class GradientMeasures(LazySequence):
+    """
+    Measures of the basis functions together with the measures of their derivatives.
+
+    `_values` and `_derivatives` are arrays of shape (M, N, dim) (e.g. as returned by `legendre_measures_grad2`).
+    `self[k]` is a lazy view of the measures in which the k-th position is replaced by the derivatives. Evaluating a tensor
+    train at `self[k]` yields the derivative with respect to the k-th variable. `self.measures` is the view without a
+    replaced position. With `_augment=True` the views have an additional constant position of ones (as for the augmented
+    measures in the experiments) whose derivatives are zero. Only `_values` and `_derivatives` are stored.
+    """
+    def __init__(self, _values, _derivatives, _augment=False):
+        assert isinstance(_values, np.ndarray) and _values.ndim == 3
+        assert isinstance(_derivatives, np.ndarray) and _derivatives.shape == _values.shape
+        self.values = _values
+        self.derivatives = _derivatives
+        self.augment = _augment
+
+    @property
+    def measures(self):
+        return SwappedMeasures(self, None)
+
+    def _get(self, _position):
+        return SwappedMeasures(self, _position)
+
+    def __len__(self):
+        return len(self.values) + int(self.augment)
+
+class SwappedMeasures(LazySequence):
+    """
+    View of the measures of a `GradientMeasures` object in which the `_position`-th position is replaced by its derivatives.
+    """
+    def __init__(self, _gradientMeasures, _position):
+        self.gradientMeasures = _gradientMeasures
+        self.position = _position
+
+    def _get(self, _position):
+        values = self.gradientMeasures.values
+        if _position == len(values):
+            constant = 0 if _position == self.position else 1
+            return np.broadcast_to(np.full(values.shape[2], constant, dtype=values.dtype), values.shape[1:])
+        if _position == self.position:
+            return self.gradientMeasures.derivatives[_position]
+        return values[_position]
+
+    def __len__(self):
+        return len(self.gradientMeasures)
+
+    @property
+    def shape(self):
+        return (len(self),) + self.gradientMeasures.values.shape[1:]
+
+def measure_chunks(_points, _measures, *_args, _chunkSize=10000, _augment=False):
+    """
+    Generate the measures of `_points` chunk by chunk.
+
+    _points : ndarray of shape (N, order) or iterable of ndarrays of shape (n, order)
+        An array is split into chunks of at most `_chunkSize` samples. The chunks of an iterable are used as they are.
+    _measures : callable
+        The measure function, e.g. `legendre_measures`. It is called as `_measures(points, *_args)`.
+    _augment : bool
+        Append a slab of ones to the measures of every chunk (as for the augmented measures in the experiments).
+    """
+    if isinstance(_points, np.ndarray):
+        assert _points.ndim == 2 and _chunkSize > 0
+        chunks = (_points[start:start+_chunkSize] for start in range(0, len(_points), _chunkSize))
+    else:
+        chunks = _points
+    for points in chunks:
+        ret = _measures(points, *_args)
+        if _augment:
+            ret = np.concatenate([ret, np.ones((1,)+ret.shape[1:])], axis=0)
+        yield ret
+
 
 # def random_nearest_neighbor_polynomial(_univariateDegrees, _nnranks):
 #     dimensions = [dim+1 for dim in _univariateDegrees]
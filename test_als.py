@@ -0,0 +1,257 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from misc import random_homogenous_polynomial_sum, random_homogenous_polynomial_sum_grad, random_homogenous_polynomial_sum_system2, \
+    legendre_measures, legendre_measures_grad2, Measures
+from helpers import fermi_pasta_ulam2, SMat
+from als import ALS, ALSGrad, ALSSystem2, local_grad_gram_system
+
+
+def augmented_legendre_measures(_points, _degree):
+    measures = legendre_measures(_points, _degree)
+    return np.concatenate([measures, np.ones((1,)+measures.shape[1:])], axis=0)
+
+def sample(_N=300, _order=5, _seed=0):
+    rng = np.random.RandomState(_seed)
+    points = 2*rng.rand(_N, _order)-1
+    values = np.sum(points**2, axis=1) + points[:,0]*points[:,1]
+    return points, values
+
+def als(_measures, _values, _degree=3, _maxGroupSize=3, _packed=False, _seed=1):
+    np.random.seed(_seed)
+    bstt = random_homogenous_polynomial_sum([_degree]*(len(_measures)-1), _degree, _maxGroupSize)
+    if _packed:
+        bstt.pack()
+    solver = ALS(bstt, _measures, _values)
+    solver.method = 'l2'
+    solver.minDecrease = 0
+    solver.targetResidual = 0
+    return solver
+
+
+def test_packed():
+    points, values = sample()
+    measures = augmented_legendre_measures(points, 3)
+    solvers = []
+    for packed in [False, True]:
+        solver = als(measures, values, _packed=packed)
+        solver.maxSweeps = 3
+        solver.run()
+        assert solver.bstt.packed == packed
+        solvers.append(solver)
+    assert np.allclose(solvers[0].residuals, solvers[1].residuals, rtol=1e-6)
+    assert np.allclose(solvers[0].bstt.evaluate(measures), solvers[1].bstt.evaluate(measures), atol=1e-6)
+
+
+def test_lazy_measures():
+    points, values = sample()
+    residuals = []
+    for measures in [augmented_legendre_measures(points, 3), Measures(points, legendre_measures, 3, _augment=True)]:
+        solver = als(measures, values)
+        solver.maxSweeps = 3
+        solver.run()
+        residuals.append(solver.residuals)
+    assert np.allclose(residuals[0], residuals[1])
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_l2gram(packed):
+    points, values = sample()
+    measures = augmented_legendre_measures(points, 3)
+    residuals = []
+    for method in ['l2', 'l2gram']:
+        solver = als(measures, values, _packed=packed)
+        solver.method = method
+        solver.chunkSize = 64
+        solver.maxSweeps = 3
+        solver.run()
+        residuals.append(solver.residuals)
+    assert np.allclose(residuals[0], residuals[1], rtol=1e-6, atol=1e-10)
+
+
+def test_stack_dtype():
+    points, values = sample()
+    measures = augmented_legendre_measures(points, 3)
+    residuals = []
+    for stackDtype in [np.float64, 'float64', np.float32]:
+        solver = als(measures, values)
+        solver.stackDtype = stackDtype
+        solver.minDecrease = 30
+        solver.maxSweeps = 6
+        solver.run()
+        residuals.append(solver.residuals)
+    # With float64 stacks (given as a type or a string) the minDecrease criterion terminates the run.
+    assert len(residuals[0]) < 7
+    assert residuals[1] == residuals[0]
+    assert np.allclose(residuals[2][:2], residuals[0][:2], rtol=1e-4)
+
+
+def test_increase_ranks():
+    points, values = sample(_N=400)
+    values = values**1.5
+    measures = augmented_legendre_measures(points, 3)
+    solver = als(measures, values, _maxGroupSize=1)
+    solver.maxGroupSize = np.int64(2)
+    solver.increaseRanks = True
+    solver.maxSweeps = 6
+    dofs = solver.bstt.dofs()
+    solver.run()
+    bstt = solver.bstt
+    assert bstt.dofs() > dofs
+    for edge in range(bstt.order-1):
+        slices = sorted({(blk[2].start, blk[2].stop) for blk in bstt.blocks[edge]})
+        for i, (start, stop) in enumerate(slices):
+            assert stop-start <= bstt.MaxSize(i, edge, 2)
+    assert np.isclose(solver.residual(), np.linalg.norm(bstt.evaluate(measures)-values)/np.linalg.norm(values))
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_truncation(packed):
+    points, values = sample(_N=1000, _order=5)
+    measures = augmented_legendre_measures(points, 4)
+    solver = als(measures, values, _degree=4, _maxGroupSize=5, _packed=packed)
+    solver.maxSweeps = 4
+    solver.run()
+    dofs, residual = solver.bstt.dofs(), solver.residual()
+    solver.truncationTolerance = 1e-8
+    solver.startSweep, solver.maxSweeps = 4, 5
+    solver.run()
+    assert solver.bstt.dofs() < dofs
+    assert solver.residual() <= 2*residual + 1e-8
+    assert np.isclose(solver.residual(), np.linalg.norm(solver.bstt.evaluate(measures)-values)/np.linalg.norm(values))
+
+
+def als_grad(_N=200, _order=4, _degree=3, _seed=1):
+    points, _ = sample(_N, _order)
+    values = 2*points + np.roll(points, 1, axis=1)  # the gradient of sum(x_k**2 + x_k*x_{k-1})
+    measures, derivatives = legendre_measures_grad2(points, _degree)
+    measures = np.concatenate([measures, np.ones((1,)+measures.shape[1:])], axis=0)
+    np.random.seed(_seed)
+    bstt = random_homogenous_polynomial_sum_grad([_degree]*_order, _degree, 3)
+    return ALSGrad(bstt, measures, derivatives, values)
+
+def test_local_grad_gram_system():
+    solver = als_grad()
+    solver.maxSweeps = 1
+    solver.run()
+    while True:
+        pos = solver.bstt.corePosition
+        L1, L2, R1, R2 = solver.leftStack1[-1], solver.leftStack2[-1], solver.rightStack1[-1], solver.rightStack2[-1]
+        # The upper block triangle is mirrored. This requires stacks that are symmetric in their outer indices.
+        for stack in [L1, L2, R1, R2]:
+            assert np.allclose(stack, stack.transpose(2, 1, 0))
+        E, E_grad = solver.measurements[pos], solver.measurements_grad[pos]
+        terms = [(L2, E, R1), (L1, E_grad, R1)]
+        if pos < solver.bstt.order-2:
+            terms.append((L1, E, R2))
+        coreBlocks = solver.bstt.blocks[pos]
+        # The original assembly: one einsum per pair of blocks and term.
+        E_op, E_grad_op = np.einsum('mp,mq->pmq', E, E), np.einsum('mp,mq->pmq', E_grad, E_grad)
+        reference = []
+        for block1 in coreBlocks:
+            row = []
+            for block2 in coreBlocks:
+                op = np.einsum('imk,pmq,lmn -> iplkqn', L2[block1[0],:, block2[0]], E_op[block1[1],:, block2[1]], R1[block1[2],:, block2[2]])
+                if pos < solver.bstt.order-2:
+                    op += np.einsum('imk,pmq,lmn -> iplkqn', L1[block1[0],:, block2[0]], E_op[block1[1],:, block2[1]], R2[block1[2],:, block2[2]])
+                op += np.einsum('imk,pmq,lmn -> iplkqn', L1[block1[0],:, block2[0]], E_grad_op[block1[1],:, block2[1]], R1[block1[2],:, block2[2]])
+                row.append(op.reshape(np.prod(op.shape[:3]), -1))
+            reference.append(np.concatenate(row, axis=1))
+        reference = np.concatenate(reference, axis=0)
+        for chunkSize in [64, 10000]:
+            assert np.allclose(local_grad_gram_system(terms, coreBlocks, chunkSize), reference)
+        if pos == solver.bstt.order-2:
+            break
+        solver.microstep()
+        solver.move_core('right')
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_grad_residual(packed):
+    solver = als_grad()
+    solver.maxSweeps = 2
+    solver.run()
+    if packed:
+        solver.bstt.pack()
+    # The original residual: evaluate the tensor train once per variable with the measure of this variable replaced by its derivative.
+    res = 0
+    for pos in range(solver.bstt.order-1):
+        measures = solver.measurements.copy()
+        measures[pos] = solver.measurements_grad[pos]
+        res += np.linalg.norm(solver.bstt.evaluate(measures) - solver.values[:,pos])**2
+    assert np.isclose(solver.residual(), np.sqrt(res) / np.linalg.norm(solver.values), rtol=1e-10)
+
+
+def test_executors_system2():
+    order, degree, interactions, N = 8, 3, 5, 300
+    np.random.seed(2)
+    points, values = fermi_pasta_ulam2(order, N, 2*np.random.rand(order), 1.4*np.random.rand(order))
+    measures = augmented_legendre_measures(points, degree)
+    selectionMatrix = SMat(interactions, order)
+    residuals = []
+    for parallel in [False, True]:
+        np.random.seed(2)
+        coeffs = random_homogenous_polynomial_sum_system2([degree]*order, degree, 2, interactions, selectionMatrix)
+        with ThreadPoolExecutor(2) as executor, ThreadPoolExecutor(2) as stackExecutor:
+            solver = ALSSystem2(coeffs, measures, values)
+            if parallel:
+                solver.executor, solver.stackExecutor = executor, stackExecutor
+            solver.maxSweeps = 3
+            solver.minDecrease = 0
+            solver.run()
+        residuals.append(solver.residuals)
+    assert np.allclose(residuals[0], residuals[1], rtol=1e-10)
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_resume_als(packed, tmp_path):
+    points, values = sample()
+    measures = augmented_legendre_measures(points, 3)
+    checkpointFile = os.path.join(tmp_path, 'als.npz')
+    def run(_sweeps, _resume):
+        solver = als(measures, values, _packed=packed)
+        solver.maxSweeps = _sweeps
+        solver.checkpointFile = checkpointFile
+        solver.checkpointInterval = 2
+        if _resume:
+            solver.resume(checkpointFile)
+        solver.run()
+        return solver
+    full = run(6, False)
+    run(4, False)
+    resumed = run(6, True)
+    assert len(resumed.residuals) == len(full.residuals) == 7
+    assert np.allclose(resumed.residuals, full.residuals, rtol=1e-8, atol=1e-14)
+    assert np.allclose(resumed.bstt.evaluate(measures), full.bstt.evaluate(measures))
+
+
+@pytest.mark.parametrize("method", ['l2', 'l2gram'])
+def test_resume_als_system2(method, tmp_path):
+    order, degree, interactions, N = 8, 3, 5, 300
+    np.random.seed(2)
+    points, values = fermi_pasta_ulam2(order, N, 2*np.random.rand(order), 1.4*np.random.rand(order))
+    measures = augmented_legendre_measures(points, degree)
+    selectionMatrix = SMat(interactions, order)
+    checkpointFile = os.path.join(tmp_path, 'als_system2.npz')
+    def run(_sweeps, _resume):
+        np.random.seed(2)
+        coeffs = random_homogenous_polynomial_sum_system2([degree]*order, degree, 2, interactions, selectionMatrix)
+        solver = ALSSystem2(coeffs, measures, values)
+        solver.method = method
+        solver.chunkSize = 64
+        solver.numberOfWorkers = 2
+        solver.maxSweeps = _sweeps
+        solver.minDecrease = 0
+        solver.checkpointFile = checkpointFile
+        if _resume:
+            solver.resume(checkpointFile)
+        solver.run()
+        return solver
+    full = run(4, False)
+    run(2, False)
+    resumed = run(4, True)
+    assert len(resumed.residuals) == len(full.residuals) == 5
+    assert np.allclose(resumed.residuals, full.residuals, rtol=1e-8, atol=1e-14)
@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+
+from misc import random_homogenous_polynomial_sum, random_homogenous_polynomial_sum_grad, random_homogenous_polynomial_sum_system2, \
+    legendre_measures, legendre_measures_grad2, measure_chunks
+from helpers import SMat
+
+
+def augmented_legendre_measures(_points, _degree):
+    measures = legendre_measures(_points, _degree)
+    return np.concatenate([measures, np.ones((1,)+measures.shape[1:])], axis=0)
+
+def random_tt(_order=5, _degree=3, _maxGroupSize=3, _seed=1):
+    np.random.seed(_seed)
+    return random_homogenous_polynomial_sum([_degree]*_order, _degree, _maxGroupSize)
+
+def reference_evaluate(_components, _measures):
+    # Contract the tensor train from left to right one sample at a time with the measures (as in the original evaluate).
+    ret = np.ones((_measures[0].shape[0], 1))
+    for comp, measure in zip(_components, _measures):
+        ret = np.einsum('nl,ne,ler -> nr', ret, measure, comp)
+    return ret[:,0]
+
+def sample_measures(_N=200, _order=5, _degree=3, _seed=0):
+    rng = np.random.RandomState(_seed)
+    return augmented_legendre_measures(2*rng.rand(_N, _order)-1, _degree)
+
+
+def test_pack():
+    bstt = random_tt()
+    measures = sample_measures()
+    components = [comp.copy() for comp in bstt.components]
+    dense = bstt.evaluate(measures)
+    bstt.pack()
+    assert bstt.packed
+    for pos in range(bstt.order):
+        assert np.array_equal(bstt.dense_component(pos), components[pos])
+    assert np.allclose(bstt.evaluate(measures), dense)
+    ones = np.ones((measures.shape[1], 1))
+    left, reference = ones, ones
+    for pos in range(bstt.order-1):
+        left = bstt.contract_left(pos, left, measures[pos])
+        reference = np.einsum('nl,ne,ler -> nr', reference, measures[pos], components[pos])
+        assert np.allclose(left, reference)
+    pos = bstt.order-1
+    assert np.allclose(bstt.contract_right(pos, ones, measures[pos]), np.einsum('ler,ne,nr -> nl', components[pos], measures[pos], ones))
+    bstt.unpack()
+    assert not bstt.packed
+    for pos in range(bstt.order):
+        assert np.array_equal(bstt.components[pos], components[pos])
+
+
+def test_move_core_packed():
+    measures = sample_measures()
+    values = []
+    for packed in [False, True]:
+        bstt = random_tt()
+        if packed:
+            bstt.pack()
+        bstt.assume_corePosition(bstt.order-1)
+        while bstt.corePosition > 0:
+            bstt.move_core('left')
+        while bstt.corePosition < bstt.order-1:
+            bstt.move_core('right')
+        assert bstt.packed == packed
+        values.append(bstt.evaluate(measures))
+    assert np.allclose(values[0], values[1])
+    assert np.allclose(values[0], random_tt().evaluate(measures))
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_evaluate(packed):
+    bstt = random_tt()
+    measures = sample_measures()
+    components = [comp.copy() for comp in bstt.components]
+    if packed:
+        bstt.pack()
+    assert np.allclose(bstt.evaluate(measures), reference_evaluate(components, measures))
+    for pos in range(bstt.order):
+        assert np.allclose(bstt.contract_measure(pos, measures[pos]), np.einsum('ne,ler -> nlr', measures[pos], components[pos]))
+
+    # The contractions are computed in the common dtype of the measures and the components.
+    bstt32 = random_tt()
+    bstt32.components = [comp.astype(np.float32) for comp in bstt32.components]
+    if packed:
+        bstt32.pack()
+    for pos in range(bstt32.order):
+        assert bstt32.contract_measure(pos, measures[pos].astype(np.float32)).dtype == np.float32
+        assert bstt32.contract_measure(pos, measures[pos]).dtype == np.float64
+
+
+def random_selection_matrix(_interactions, _order, _rng):
+    # Every row is non-increasing: interactions-1 for at least one position, then a subset of the intermediate values
+    # (each at most once) and 0 for at least one position.
+    S = np.zeros((_order, _order+1), dtype=int)
+    for eq in range(_order):
+        middle = sorted(_rng.choice(np.arange(1, _interactions-1), _rng.randint(0, _interactions-1), replace=False), reverse=True)
+        start = _rng.randint(1, _order-len(middle)+1)
+        S[eq] = [_interactions-1]*start + middle + [0]*(_order+1-start-len(middle))
+    return S
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_evaluate_system2(packed):
+    order, degree = 5, 3
+    rng = np.random.RandomState(3)
+    measures = sample_measures(_order=order, _degree=degree)
+    selectionMatrices = [SMat(interactions, order) for interactions in [3, 4, 5]]
+    selectionMatrices += [random_selection_matrix(4, order, rng) for _ in range(20)]
+    duplicated = SMat(4, order)
+    duplicated[1] = duplicated[0]
+    duplicated[3] = duplicated[4] = duplicated[2]
+    selectionMatrices.append(duplicated)
+    for S in selectionMatrices:
+        np.random.seed(4)
+        system = random_homogenous_polynomial_sum_system2([degree]*order, degree, 2, int(np.max(S))+1, S)
+        components = [[bstt.dense_component(pos) for pos in range(bstt.order)] for bstt in system.bstts]
+        if packed:
+            system.pack()
+        values = system.evaluate(measures)
+        assert values.shape == (measures.shape[1], order)
+        for eq in range(order):
+            reference = reference_evaluate([components[system.selectionMatrix[eq,pos]][pos] for pos in range(order+1)], measures)
+            assert np.allclose(values[:,eq], reference)
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_evaluate_stream(packed):
+    order, degree = 5, 3
+    points = 2*np.random.RandomState(0).rand(300, order)-1
+    measures = augmented_legendre_measures(points, degree)
+    bstt = random_tt(order, degree)
+    np.random.seed(4)
+    system = random_homogenous_polynomial_sum_system2([degree]*order, degree, 2, 4, SMat(4, order))
+    if packed:
+        bstt.pack()
+        system.pack()
+    for tt in [bstt, system]:
+        chunks = list(tt.evaluate_stream(measure_chunks(points, legendre_measures, degree, _chunkSize=128, _augment=True)))
+        assert [len(chunk) for chunk in chunks] == [128, 128, 44]
+        assert np.allclose(np.concatenate(chunks), tt.evaluate(measures))
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_gradient(packed):
+    order, degree = 5, 3
+    points = 2*np.random.RandomState(0).rand(200, order)-1
+    values, derivatives = legendre_measures_grad2(points, degree)
+    measures = np.concatenate([values, np.ones((1,)+values.shape[1:])], axis=0)
+    np.random.seed(2)
+    bstt = random_homogenous_polynomial_sum_grad([degree]*order, degree, 3)
+    if packed:
+        bstt.pack()
+    for m in [order, order-1]:
+        gradient = bstt.gradient(measures, derivatives[:m])
+        assert gradient.shape == (len(points), m)
+        for k in range(m):
+            swapped = measures.copy()
+            swapped[k] = derivatives[k]
+            assert np.allclose(gradient[:,k], bstt.evaluate(swapped))
@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+from helpers import fermi_pasta_ulam, fermi_pasta_ulam2, massive_particles, lennardJonesParam2, lennardJonesParam2Mod, \
+    lennardJonesParam3Mod, magneticDipolesParam2
+
+
+# Reference implementations: the original loops over the samples and the particles.
+
+def reference_fermi_pasta_ulam(snapshots):
+    derivatives = np.zeros(snapshots.shape)
+    for j in range(snapshots.shape[1]):
+        derivatives[0, j] = snapshots[1, j] - 2 * snapshots[0, j] + 0.7 * (
+                (snapshots[1, j] - snapshots[0, j]) ** 3 - snapshots[0, j] ** 3)
+        for i in range(1, snapshots.shape[0] - 1):
+            derivatives[i, j] = snapshots[i + 1, j] - 2 * snapshots[i, j] + snapshots[i - 1, j] + 0.7 * (
+                    (snapshots[i + 1, j] - snapshots[i, j]) ** 3 - (snapshots[i, j] - snapshots[i - 1, j]) ** 3)
+        derivatives[-1, j] = - 2 * snapshots[-1, j] + snapshots[-2, j] + 0.7 * (
+                -snapshots[-1, j] ** 3 - (snapshots[-1, j] - snapshots[-2, j]) ** 3)
+    return derivatives
+
+def reference_fermi_pasta_ulam2(snapshots, kappa, beta):
+    derivatives = np.zeros(snapshots.shape)
+    for j in range(snapshots.shape[1]):
+        derivatives[0, j] = kappa[1] * (snapshots[1, j] - snapshots[0, j]) - kappa[0] * snapshots[0, j] + beta[1] * (
+            snapshots[1, j] - snapshots[0, j]) ** 3 - beta[0] * snapshots[0, j] ** 3
+        for i in range(1, snapshots.shape[0] - 1):
+            derivatives[i, j] = kappa[i+1] * (snapshots[i + 1, j] - snapshots[i, j]) - kappa[i] * (snapshots[i, j] - snapshots[i - 1, j]) + beta[i+1] * (
+                    snapshots[i + 1, j] - snapshots[i, j]) ** 3 - beta[i] * (snapshots[i, j] - snapshots[i - 1, j]) ** 3
+        derivatives[-1, j] = - kappa[-1] * snapshots[-1, j] - kappa[-2] * (snapshots[-1, j] - snapshots[-2, j]) + beta[-1] * (
+                -snapshots[-1, j]) ** 3 - beta[-2] * (snapshots[-1, j] - snapshots[-2, j]) ** 3
+    return derivatives
+
+def reference_massive_particles(x, G, m):
+    xdot = np.zeros(x.shape)
+    for j in range(x.shape[1]):
+        for i in range(x.shape[0]):
+            for k in range(x.shape[0]):
+                if k != i:
+                    diff = x[i,j]-x[k,j]
+                    xdot[i, j] -= G*m[i]*m[k]/(np.abs(diff)**3)*diff
+    return xdot
+
+def reference_lennardJonesParam2(x, sigma, exp):
+    n = len(x)
+    res = np.zeros([n])
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                res[i] += np.sign(x[i]-x[j])*6/sigma[i,j]*((sigma[i,j]/np.abs(x[i]-x[j]))**(2*exp+1) -(sigma[i,j]/np.abs(x[i]-x[j]))**(exp+1)  )
+    return res
+
+def reference_lennardJonesParamMod(x, exp, signed):
+    n = len(x)
+    res = np.zeros([n])
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                if signed:
+                    res[i] += np.sign(x[i]-x[j])*((1/np.abs(x[i]-x[j]))**(2*exp+1) -(1/np.abs(x[i]-x[j]))**(exp+1)  )
+                else:
+                    res[i] +=((1/(x[i]-x[j]))**(2*exp+1) -(1/(x[i]-x[j]))**(exp+1)  )
+        if i > 0:
+            res[i]*= (x[i]-x[i-1])**(2*exp+1)
+        if i < n-1:
+            res[i]*= (x[i]-x[i+1])**(2*exp+1)
+    return res
+
+def reference_magneticDipolesParam2(phi, M, x):
+    n = len(phi)
+    res = np.zeros([n])
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                res[i] += M[i]*M[j]/(np.abs(x[i]-x[j])**3)*np.sin(phi[j]-phi[i])
+    return res
+
+
+@pytest.mark.parametrize("order", [2, 3, 7])
+def test_fermi_pasta_ulam(order):
+    np.random.seed(0)
+    snapshots, derivatives = fermi_pasta_ulam(order, 50)
+    np.random.seed(0)
+    assert np.array_equal(snapshots, (2 * np.random.rand(order, 50) - 1).T)
+    assert np.allclose(derivatives, reference_fermi_pasta_ulam(snapshots.T).T)
+
+
+@pytest.mark.parametrize("order", [2, 3, 7])
+@pytest.mark.parametrize("extra", [0, 1])
+def test_fermi_pasta_ulam2(order, extra):
+    # kappa and beta may have one entry per oscillator or an additional entry for the spring at the right boundary.
+    rng = np.random.RandomState(1)
+    kappa, beta = 2*rng.rand(order+extra), 1.4*rng.rand(order+extra)
+    np.random.seed(0)
+    snapshots, derivatives = fermi_pasta_ulam2(order, 50, kappa, beta)
+    assert np.allclose(derivatives, reference_fermi_pasta_ulam2(snapshots.T, kappa, beta).T)
+    snapshots, derivatives = fermi_pasta_ulam2(order, 50, list(kappa), list(beta))
+    assert np.allclose(derivatives, reference_fermi_pasta_ulam2(snapshots.T, kappa, beta).T)
+
+
+def test_massive_particles():
+    m = 1+np.random.RandomState(1).rand(5)
+    np.random.seed(0)
+    x, xdot = massive_particles(5, 50, 0.5, list(m), 2.0)
+    assert np.allclose(xdot, reference_massive_particles(x, 0.5, m))
+
+
+def test_lennard_jones():
+    order, exp = 6, 3
+    rng = np.random.RandomState(1)
+    samples = np.cumsum(np.column_stack([rng.rand(40), 1+rng.rand(40, order-1)]), axis=1).T
+    sigma = 1+0.1*rng.rand(order, order)
+    sigma = (sigma+sigma.T)/2
+    for function, reference, args in [(lennardJonesParam2, lambda x: reference_lennardJonesParam2(x, sigma, exp), (sigma, exp)),
+                      (lennardJonesParam2Mod, lambda x: reference_lennardJonesParamMod(x, exp, True), (exp,)),
+                      (lennardJonesParam3Mod, lambda x: reference_lennardJonesParamMod(x, exp, False), (exp,))]:
+        derivatives = function(samples, *args)
+        assert derivatives.shape == samples.shape
+        for k in range(samples.shape[1]):
+            assert np.allclose(derivatives[:,k], reference(samples[:,k]))
+            assert np.allclose(function(samples[:,k], *args), derivatives[:,k])
+
+
+def test_magnetic_dipoles():
+    order = 5
+    rng = np.random.RandomState(1)
+    phi = np.pi*(2*rng.rand(order, 40)-1)
+    M, x = 1+rng.rand(order), np.arange(order)+0.3*rng.rand(order)
+    derivatives = magneticDipolesParam2(phi, list(M), list(x), 1)
+    assert derivatives.shape == phi.shape
+    for k in range(phi.shape[1]):
+        assert np.allclose(derivatives[:,k], reference_magneticDipolesParam2(phi[:,k], M, x))
+        assert np.allclose(magneticDipolesParam2(phi[:,k], M, x, 1), derivatives[:,k])
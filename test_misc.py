@@ -0,0 +1,59 @@
+import numpy as np
+
+from misc import legendre_measures, legendre_measures_grad, legendre_measures_grad2, legendre_gradient_measures, measure_chunks, Measures
+
+
+def sample_points(_N=300, _order=5, _seed=0):
+    return 2*np.random.RandomState(_seed).rand(_N, _order)-1
+
+
+def test_measure_chunks():
+    points = sample_points()
+    measures = legendre_measures(points, 3)
+    chunks = list(measure_chunks(points, legendre_measures, 3, _chunkSize=128))
+    assert [chunk.shape[1] for chunk in chunks] == [128, 128, 44]
+    assert np.array_equal(np.concatenate(chunks, axis=1), measures)
+    chunks = list(measure_chunks(points, legendre_measures, 3, _chunkSize=128, _augment=True))
+    assert np.array_equal(np.concatenate(chunks, axis=1), np.concatenate([measures, np.ones((1,)+measures.shape[1:])], axis=0))
+    # The chunks of an iterable of point arrays are used as they are.
+    chunks = list(measure_chunks((points[:100], points[100:]), legendre_measures, 3))
+    assert [chunk.shape[1] for chunk in chunks] == [100, 200]
+    assert np.array_equal(np.concatenate(chunks, axis=1), measures)
+
+
+def test_measures():
+    points = sample_points()
+    measures = legendre_measures(points, 3)
+    for cache in [False, True]:
+        lazy = Measures(points, legendre_measures, 3, _cache=cache)
+        assert lazy.shape == measures.shape and len(lazy) == len(measures)
+        assert np.array_equal(lazy.toarray(), measures)
+        assert np.array_equal(lazy[-1], measures[-1])
+    lazy = Measures(points, legendre_measures, 3, _augment=True)
+    assert lazy.shape == (len(measures)+1,)+measures.shape[1:]
+    assert np.array_equal(lazy.toarray()[:-1], measures)
+    assert np.all(lazy[len(measures)] == 1)
+
+
+def test_gradient_measures():
+    points = sample_points()
+    order, degree = points.shape[1], 3
+    grad = legendre_measures_grad(points, degree)
+    assert isinstance(grad, list) and len(grad) == order
+    gradientMeasures = legendre_gradient_measures(points, degree)
+    assert len(gradientMeasures) == len(gradientMeasures[0]) == order
+    for k in range(order):
+        assert gradientMeasures[k].shape == grad[k].shape
+        assert np.array_equal(gradientMeasures[k].toarray(), grad[k])
+    assert np.array_equal(gradientMeasures.toarray(), np.stack(grad))
+    assert np.array_equal(gradientMeasures.measures.toarray(), legendre_measures_grad2(points, degree)[0])
+    assert np.array_equal(gradientMeasures[-1][-1], grad[-1][-1])
+
+    # The augmented position is constant: its measures are ones and its derivatives are zero.
+    gradientMeasures = legendre_gradient_measures(points, degree, _augment=True)
+    assert len(gradientMeasures) == len(gradientMeasures[0]) == len(gradientMeasures.measures) == order+1
+    for k in range(order):
+        assert np.array_equal(gradientMeasures[k].toarray()[:order], grad[k])
+        assert np.all(gradientMeasures[k][order] == 1)
+    assert np.all(gradientMeasures[order][order] == 0)
+    assert np.array_equal(gradientMeasures[order].toarray()[:order], gradientMeasures.measures.toarray()[:order])